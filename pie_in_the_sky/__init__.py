@@ -3,10 +3,36 @@
 from .metadata import *
 from .world import *
 from .referee import *
-from .gui import *
 from .ai import *
 
 def main():
-    import kxg
-    kxg.quickstart.main(World, Referee, Gui, GuiActor, AiActor)
+    import kxg, sys, functools
+    from .gui import Gui, GuiActor
 
+    # Thin client mode (see World.thin_client) has to be turned on for the 
+    # server as well as the clients, because the referee has to know to send 
+    # snapshots.  kxg doesn't know about the option, so take it out of the 
+    # arguments before they're passed on.
+
+    argv = sys.argv[1:]
+    world_cls = World
+
+    if '--thin-client' in argv:
+        argv = [x for x in argv if x != '--thin-client']
+        world_cls = functools.partial(World, thin_client=True)
+
+    kxg.quickstart.main(
+            world_cls, Referee, Gui, GuiActor, AiActor, argv=argv)
+
+def __getattr__(name):
+    # The gui depends on pyglet and glooey, which aren't needed (or wanted) for
+    # headless games.  So only import it when one of its names is asked for.  
+    # Names of submodules are left for the import system to find, otherwise 
+    # `from . import <submodule>` would end up back here.
+    import importlib, importlib.util
+    if not name.startswith('_') and \
+            importlib.util.find_spec('.' + name, __name__) is None:
+        gui = importlib.import_module('.gui', __name__)
+        if hasattr(gui, name):
+            return getattr(gui, name)
+    raise AttributeError("module {!r} has no attribute {!r}".format(__name__, name))
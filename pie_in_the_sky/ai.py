@@ -1,8 +1,7 @@
 #!/usr/bin/env python3
 
-import kxg, random
+import kxg
 from . import tokens, messages
-from vecrec import Vector
 
 class AiActor (kxg.Actor):
 
@@ -36,21 +35,13 @@ class CannonExtension (kxg.TokenExtension):
         if self.shot_timer < 0:
             self.reset_shot_timer()
 
-            # Pick the closest target to aim at.
-
-            def distance_to_cannon(target):
-                return cannon.position.get_distance(target.position)
-
-            if self.token.player.targets:
-                target = sorted(player.targets, key=distance_to_cannon)[0]
-            else:
-                target = world.final_target
+            target = self.pick_target()
 
             # Aim in front of the target with some variance.
 
             aim = target.position - cannon.position
             aim += 0.0 * target.velocity
-            aim += 0.05 * aim.magnitude * Vector.random()
+            aim += 0.05 * aim.magnitude * world.random_vector()
             aim.normalize()
 
             velocity = cannon.muzzle_speed * aim
@@ -64,7 +55,23 @@ class CannonExtension (kxg.TokenExtension):
             else:
                 self.shot_timer /= 2
 
+    def pick_target(self):
+        """
+        Return the closest of the player's targets, or the final target if the 
+        player has already hit all of their own targets.
+        """
+        cannon = self.token
+        player = self.token.player
+
+        def distance_to_cannon(target):
+            return cannon.position.get_distance(target.position)
+
+        if player.targets:
+            return min(player.targets, key=distance_to_cannon)
+        else:
+            return cannon.world.final_target
+
     def reset_shot_timer(self):
-        self.shot_timer = random.uniform(0.5, 1.5)
+        self.shot_timer = self.token.world.random.uniform(0.5, 1.5)
 
 
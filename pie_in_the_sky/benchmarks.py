@@ -0,0 +1,497 @@
+#!/usr/bin/env python3
+
+"""
+Time the hot paths of the game in isolation.
+
+Each benchmark is run against a headless match (no window is opened) that has
+been started from a seeded scenario with bullets already in flight, so the
+results don't depend on how anyone plays.  Every benchmark is sampled several
+times, and the minimum, median, mean, and standard deviation of the samples
+are reported.  Results can be saved as JSON and compared against the results
+from another commit.
+
+The accuracy of the approximate gravity solvers can also be compared to the 
+exact pairwise result with `--gravity-error`.  This reports the error in the 
+forces for each solver, and how far the trajectories calculated with the 
+test-particle solver drift from the exact ones over time.
+
+Usage:
+    python -m pie_in_the_sky.benchmarks [--bullets N] [--json FILE]
+                                        [--compare FILE] [NAME ...]
+    python -m pie_in_the_sky.benchmarks --gravity-error [--sizes N ...]
+                                        [--drift-time SECONDS]
+"""
+
+import kxg, time, json, statistics, collections
+import numpy as np
+from kxg.multiplayer import MessageSerializer
+from . import gravity, headless, messages, scenarios, tokens
+
+Benchmark = collections.namedtuple('Benchmark', 'name, function, mutates')
+
+BENCHMARKS = []
+
+def benchmark(name, mutates=False):
+    """
+    Register a benchmark.
+
+    The decorated function is given a freshly prepared match and must return
+    a callable that performs the operation being timed.  If the operation
+    changes the world in a way that would affect the next sample (e.g. by
+    removing tokens), set `mutates` so that every sample gets its own match
+    and the operation is only called once per sample.
+    """
+    def decorator(function):
+        BENCHMARKS.append(Benchmark(name, function, mutates))
+        return function
+    return decorator
+
+
+def prepare_match(num_ais=2, num_bullets=50, seed=0):
+    """
+    Start a seeded headless match with the given number of bullets already in
+    flight.
+    """
+    scenario = scenarios.Scenario(
+            num_players=num_ais,
+            targets_per_player=2,
+            num_obstacles=2,
+            num_bullets=num_bullets,
+    )
+    referee = scenarios.ScenarioReferee(scenario)
+    match = headless.setup_match(num_ais, seed=seed, referee=referee)
+    match.theater.update(1/50)
+    return match
+
+def measure(benchmark, num_bullets, repeat=7, min_time=0.05):
+    """
+    Return a list of samples for the given benchmark, in seconds per call.
+    """
+    samples = []
+
+    if not benchmark.mutates:
+        run = benchmark.function(prepare_match(num_bullets=num_bullets))
+        number = pick_number(run, min_time)
+
+    for i in range(repeat):
+        if benchmark.mutates:
+            run = benchmark.function(prepare_match(num_bullets=num_bullets))
+            number = 1
+        samples.append(time_calls(run, number) / number)
+
+    return samples
+
+def pick_number(run, min_time=0.05):
+    """
+    Return how many times the given callable has to be called in a row to 
+    take at least `min_time` seconds.
+    """
+    number = 1
+    while time_calls(run, number) < min_time:
+        number *= 2
+    return number
+
+def time_calls(run, number):
+    start = time.perf_counter()
+    for i in range(number):
+        run()
+    return time.perf_counter() - start
+
+def summarize(samples):
+    return {
+            'min': min(samples),
+            'median': statistics.median(samples),
+            'mean': statistics.mean(samples),
+            'stdev': statistics.stdev(samples) if len(samples) > 1 else 0,
+            'samples': len(samples),
+    }
+
+def git_commit():
+    import subprocess
+    try:
+        return subprocess.check_output(
+                ['git', 'rev-parse', 'HEAD'],
+                stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+# Note that World methods which change the world are only allowed to be called
+# while the world is unlocked, which normally only happens while the game
+# engine is updating the world or executing a message.  The benchmarks below
+# unlock it themselves to call those methods directly.
+
+@benchmark('gravity')
+def bench_gravity(match):
+    world = match.world
+
+    def run():
+        with world._unlock_temporarily():
+            world.reset_forces()
+            world.apply_gravity()
+
+    return run
+
+# Time each gravity solver on its own, without applying the forces to the 
+# pymunk bodies, so they can be compared at any number of bullets.
+
+def bench_gravity_solver(solver, *args):
+    def function(match):
+        world = match.world
+        world.update_field_state()
+        state = world.field_state
+        extra_args = [x(world) if callable(x) else x for x in args]
+        return lambda: solver(
+                state.positions, state.masses, world.gravity_constant,
+                *extra_args)
+    return function
+
+def is_gravity_source(world):
+    return [not isinstance(x, tokens.Bullet) for x in world.field_state.objects]
+
+GRAVITY_SOLVERS = {
+        'vectorized': (gravity.vectorized_forces,),
+        'barnes_hut': (gravity.barnes_hut_forces, 0.5),
+        'test_particle': (gravity.test_particle_forces, is_gravity_source),
+}
+
+for name, (solver, *args) in GRAVITY_SOLVERS.items():
+    benchmark('gravity_' + name)(bench_gravity_solver(solver, *args))
+
+@benchmark('space_step', mutates=True)
+def bench_space_step(match):
+    world = match.world
+
+    def run():
+        with world._unlock_temporarily():
+            for i in range(10):
+                world.space.step(world.physics_dt)
+
+    return run
+
+@benchmark('sync_worlds_construct')
+def bench_sync_worlds_construct(match):
+    return lambda: messages.SyncWorlds(match.world)
+
+@benchmark('sync_worlds_apply')
+def bench_sync_worlds_apply(match):
+    world = match.world
+    message = messages.SyncWorlds(world)
+
+    def run():
+        with world._unlock_temporarily():
+            message.apply(world)
+
+    return run
+
+# The benchmark matches run the referee, whose world ignores sync messages, so 
+# the sync benchmarks call apply() directly to measure what a client does.
+#
+# Compare the cost of getting a sync message across the network (i.e. 
+# building and serializing it on the server, then deserializing and applying 
+# it on the client) for each encoding, and for the old format, which pickled a 
+# dictionary mapping each token to its position and velocity.
+
+class DictSyncWorlds (kxg.Message):
+
+    def __init__(self, world):
+        self.state = {
+                token: (token.position.xy, token.velocity.xy)
+                for token in world.field_objects
+        }
+
+    def apply(self, world):
+        for token in self.state:
+            token.body.position, token.body.velocity = self.state[token]
+
+        world.update_field_state()
+
+SYNC_FORMATS = {
+        'dict': DictSyncWorlds,
+        'float32': lambda world: messages.SyncWorlds(world, 'float32'),
+        'int16': lambda world: messages.SyncWorlds(world, 'int16'),
+}
+
+def bench_sync_encode(make_message):
+    def function(match):
+        serializer = MessageSerializer(match.world)
+        return lambda: serializer.pack(make_message(match.world))
+    return function
+
+def bench_sync_decode(make_message):
+    def function(match):
+        world = match.world
+        serializer = MessageSerializer(world)
+        packet = serializer.pack(make_message(world))
+
+        def run():
+            message = serializer.unpack(packet)
+            with world._unlock_temporarily():
+                message.apply(world)
+
+        return run
+    return function
+
+for encoding, make_message in SYNC_FORMATS.items():
+    benchmark('sync_encode_' + encoding)(bench_sync_encode(make_message))
+    benchmark('sync_decode_' + encoding)(bench_sync_decode(make_message))
+
+@benchmark('sync_worlds_find_drifted')
+def bench_sync_worlds_find_drifted(match):
+    referee = match.referee
+    referee.record_sync_baselines(match.world.field_objects)
+    return referee.find_drifted_tokens
+
+@benchmark('sync_predictions_advance')
+def bench_sync_predictions_advance(match):
+    referee = match.referee
+    referee.record_sync_baselines(match.world.field_objects)
+    return lambda: referee.sync_predictions.advance(match.world, 1/50)
+
+@benchmark('hit_target', mutates=True)
+def bench_hit_target(match):
+    world, referee = match.world, match.referee
+
+    hits = pick_harmless_hits(world)
+
+    def run():
+        for bullet, target in hits:
+            referee >> messages.HitTarget(bullet, target)
+
+    return run
+
+@benchmark('hit_batch', mutates=True)
+def bench_hit_batch(match):
+    world, referee = match.world, match.referee
+    hits = pick_harmless_hits(world)
+
+    def run():
+        referee >> messages.HitBatch([
+            messages.HitTarget(bullet, target) for bullet, target in hits])
+
+    return run
+
+def pick_harmless_hits(world):
+    # Have every bullet hit a target belonging to somebody else, so that only
+    # the bullet is removed and the same target can be reused.
+
+    hits = []
+    for bullet in world.bullets:
+        others = [x for x in world.targets if x.owner not in (bullet.player, None)]
+        hits.append((bullet, others[0]))
+
+    return hits
+
+@benchmark('world_snapshot')
+def bench_world_snapshot(match):
+    return match.world.snapshot
+
+@benchmark('world_restore')
+def bench_world_restore(match):
+    world = match.world
+    snapshot = world.snapshot()
+
+    def run():
+        with world._unlock_temporarily():
+            world.restore(snapshot)
+
+    return run
+
+@benchmark('ai_pick_target')
+def bench_ai_pick_target(match):
+    ai = match.ais[0]
+    cannon = ai.player.cannons[0]
+    extension = cannon.get_extension(ai)
+    return extension.pick_target
+
+
+def random_field(num_objects, num_heavy=10, seed=0):
+    """
+    Return the positions, velocities, and masses of a random field of the 
+    given size.  The first `num_heavy` objects are targets and obstacles; the 
+    rest are bullets.
+    """
+    from .world import World
+
+    rng = np.random.default_rng(seed)
+    positions = rng.uniform((0, 0), World.field_size, size=(num_objects, 2))
+    masses = np.ones(num_objects)
+    masses[:num_heavy] = rng.choice([2, 5], size=min(num_objects, num_heavy))
+    velocities = rng.normal(0, 50, size=(num_objects, 2))
+    return positions, velocities, masses
+
+def gravity_errors(num_objects, thetas=(0.3, 0.5, 1.0), num_heavy=10, seed=0):
+    """
+    Return a dictionary mapping each approximate gravity solver to the mean 
+    and maximum error of the forces it calculates for a random field of the 
+    given size, relative to the exact pairwise forces.
+    """
+    from .world import World
+
+    positions, velocities, masses = random_field(num_objects, num_heavy, seed)
+    G = World.gravity_constant
+
+    exact = gravity.vectorized_forces(positions, masses, G)
+    scale = np.linalg.norm(exact, axis=1)
+    scale[scale == 0] = 1
+
+    approximations = {
+            'barnes_hut({})'.format(theta):
+                gravity.barnes_hut_forces(positions, masses, G, theta)
+            for theta in thetas
+    }
+    approximations['test_particle'] = gravity.test_particle_forces(
+            positions, masses, G, masses > 1)
+
+    errors = {}
+    for name, forces in approximations.items():
+        error = np.linalg.norm(forces - exact, axis=1) / scale
+        errors[name] = error.mean(), error.max()
+
+    return errors
+
+def gravity_drift(num_objects, duration=2, num_reports=4, num_heavy=10, seed=0):
+    """
+    Integrate the same random field with the test-particle solver and with the 
+    exact solver, and return how much faster the test-particle solver is, 
+    along with a list of (time, bullet drift, heavy object drift) tuples 
+    giving how far apart the two sets of trajectories are at `num_reports` 
+    evenly spaced times.  The median distance is reported, because a few 
+    close encounters can fling objects across the field with either solver.
+
+    The field is integrated the same way pymunk does it (semi-implicit Euler 
+    with steps of World.physics_dt), but without walls or collisions, so that 
+    only the difference in gravity is measured.
+    """
+    from .world import World
+
+    positions, velocities, masses = random_field(num_objects, num_heavy, seed)
+    is_source = masses > 1
+    G = World.gravity_constant
+    dt = World.physics_dt
+
+    def exact(positions):
+        return gravity.vectorized_forces(positions, masses, G)
+
+    def approx(positions):
+        return gravity.test_particle_forces(positions, masses, G, is_source)
+
+    def time_solver(solver):
+        run = lambda: solver(positions)
+        number = pick_number(run)
+        return min(time_calls(run, number) for i in range(3)) / number
+
+    speedup = time_solver(exact) / time_solver(approx)
+
+    trajectories = [
+            [positions.copy(), velocities.copy()] for solver in (exact, approx)
+    ]
+    num_steps = int(round(duration / dt))
+    report_every = max(num_steps // num_reports, 1)
+    drifts = []
+
+    for step in range(1, num_steps + 1):
+        for solver, (x, v) in zip((exact, approx), trajectories):
+            v += dt * solver(x) / masses[:,np.newaxis]
+            x += dt * v
+
+        if step % report_every == 0:
+            drift = np.linalg.norm(
+                    trajectories[1][0] - trajectories[0][0], axis=1)
+            drifts.append((
+                    step * dt,
+                    np.median(drift[~is_source]) if np.any(~is_source) else 0,
+                    np.median(drift[is_source]) if np.any(is_source) else 0,
+            ))
+
+    return speedup, drifts
+
+def print_gravity_errors(sizes, drift_time=2):
+    print("Force error relative to the exact pairwise result:")
+    print()
+    print('{:>6s}  {:<18s}  {:>10s}  {:>10s}'.format(
+        'N', 'solver', 'mean err', 'max err'))
+
+    for n in sizes:
+        for name, (mean, max) in gravity_errors(n).items():
+            print('{:6d}  {:<18s}  {:10.2e}  {:10.2e}'.format(n, name, mean, max))
+
+    print()
+    print("Trajectory drift of test_particle relative to the exact solver:")
+    print()
+    print('{:>6s}  {:>8s}  {:>8s}  {:>14s}  {:>14s}'.format(
+        'N', 'speedup', 'time (s)', 'bullet drift', 'heavy drift'))
+
+    for n in sizes:
+        speedup, drifts = gravity_drift(n, drift_time)
+        for i, (t, bullet_drift, heavy_drift) in enumerate(drifts):
+            print('{:>6s}  {:>8s}  {:8.2f}  {:12.2f}px  {:12.2f}px'.format(
+                str(n) if i == 0 else '',
+                '{:.1f}x'.format(speedup) if i == 0 else '',
+                t, bullet_drift, heavy_drift))
+
+
+def main():
+    import argparse, sys
+
+    parser = argparse.ArgumentParser(
+            description="Time the hot paths of the game.")
+    parser.add_argument('names', nargs='*',
+            help="benchmarks to run (default: all)")
+    parser.add_argument('--bullets', type=int, default=50,
+            help="number of bullets in flight")
+    parser.add_argument('--repeat', type=int, default=7,
+            help="number of samples to take for each benchmark")
+    parser.add_argument('--json', metavar='FILE',
+            help="save the results to the given file")
+    parser.add_argument('--compare', metavar='FILE',
+            help="compare the results to those saved in the given file")
+    parser.add_argument('--gravity-error', action='store_true',
+            help="compare the accuracy of the gravity solvers instead")
+    parser.add_argument('--sizes', type=int, nargs='+', default=[100, 1000],
+            help="number of objects to compare the gravity solvers with")
+    parser.add_argument('--drift-time', type=float, default=2,
+            help="simulated seconds over which to measure trajectory drift")
+    args = parser.parse_args()
+
+    if args.gravity_error:
+        print_gravity_errors(args.sizes, args.drift_time)
+        return
+
+    benchmarks = [x for x in BENCHMARKS if not args.names or x.name in args.names]
+    baseline = {}
+
+    if args.compare:
+        with open(args.compare) as file:
+            baseline = json.load(file)['results']
+
+    results = {}
+
+    print('{:<24s}  {:>12s}  {:>12s}  {:>10s}  {:>8s}'.format(
+        'benchmark', 'min (us)', 'median (us)', 'stdev', 'change'))
+
+    for bench in benchmarks:
+        results[bench.name] = stats = summarize(
+                measure(bench, args.bullets, args.repeat))
+
+        change = ''
+        if bench.name in baseline:
+            change = '{:+.1%}'.format(
+                    stats['median'] / baseline[bench.name]['median'] - 1)
+
+        print('{:<24s}  {:12.2f}  {:12.2f}  {:9.1%}  {:>8s}'.format(
+            bench.name, 1e6 * stats['min'], 1e6 * stats['median'],
+            stats['stdev'] / stats['mean'], change))
+
+    if args.json:
+        with open(args.json, 'w') as file:
+            json.dump({
+                'commit': git_commit(),
+                'python': sys.version,
+                'bullets': args.bullets,
+                'results': results,
+            }, file, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,186 @@
+#!/usr/bin/env python3
+
+"""
+Array-based gravity solvers.
+
+Each solver takes an (N, 2) array of positions and an (N,) array of masses
+and returns an (N, 2) array containing the net gravitational force acting on
+each object.  The world is responsible for gathering these arrays from the
+pymunk bodies and for applying the resulting forces.
+"""
+
+import numpy as np
+
+def vectorized_forces(positions, masses, G):
+    """
+    Compute the exact pairwise force on every object in one batched pass.
+
+    This gives the same result as summing over every pair of objects, but the
+    O(N²) work is done by numpy instead of by the python interpreter.  Objects
+    that sit exactly on top of each other don't exert any force on each other.
+    """
+    positions = np.asarray(positions, dtype=float)
+    masses = np.asarray(masses, dtype=float)
+
+    # dist[i,j] is the vector pointing from object i to object j.
+
+    dist = positions[np.newaxis,:,:] - positions[:,np.newaxis,:]
+    dist_squared = np.einsum('ijk,ijk->ij', dist, dist)
+
+    with np.errstate(divide='ignore'):
+        inv_dist_cubed = dist_squared ** -1.5
+    inv_dist_cubed[dist_squared == 0] = 0
+
+    field = np.einsum('ij,ijk->ik', masses * inv_dist_cubed, dist)
+    return G * masses[:,np.newaxis] * field
+
+def test_particle_forces(positions, masses, G, is_source):
+    """
+    Compute the force on every object, but only from the objects marked as 
+    sources.
+
+    Objects that aren't sources are treated as test particles: they feel the 
+    gravity of the sources, but they don't pull on anything themselves.  This 
+    makes the cost O(N × sources) rather than O(N²), which is a big savings 
+    when most objects are light (i.e. bullets).
+    """
+    positions = np.asarray(positions, dtype=float)
+    masses = np.asarray(masses, dtype=float)
+    is_source = np.asarray(is_source, dtype=bool)
+
+    dist = positions[np.newaxis,is_source,:] - positions[:,np.newaxis,:]
+    dist_squared = np.einsum('ijk,ijk->ij', dist, dist)
+
+    with np.errstate(divide='ignore'):
+        inv_dist_cubed = dist_squared ** -1.5
+    inv_dist_cubed[dist_squared == 0] = 0
+
+    field = np.einsum('ij,ijk->ik', masses[is_source] * inv_dist_cubed, dist)
+    return G * masses[:,np.newaxis] * field
+
+def barnes_hut_forces(positions, masses, G, theta=0.5, leaf_size=8):
+    """
+    Approximate the force on every object using a Barnes–Hut quadtree.
+
+    Groups of objects that are far away (relative to the size of the group) 
+    are treated as a single object located at their center of mass.  The 
+    opening angle theta controls what "far away" means: a node of width s at 
+    distance d is approximated if s/d < theta.  A theta of 0 reproduces the 
+    exact pairwise result, while larger values trade accuracy for speed.  The 
+    cost is O(N log N) instead of O(N²).
+
+    Rather than walking the tree once per object, every object that needs to 
+    look at a node is processed in the same numpy operation, so the python 
+    interpreter only visits each node of the tree once.
+    """
+    positions = np.asarray(positions, dtype=float)
+    masses = np.asarray(masses, dtype=float)
+    field = np.zeros_like(positions)
+
+    if len(positions) == 0:
+        return field
+
+    root = QuadTree(positions, masses, leaf_size)
+    stack = [(root, np.arange(len(positions)))]
+
+    while stack:
+        node, targets = stack.pop()
+
+        if node.is_leaf:
+            sources = node.indices
+            dist = positions[np.newaxis,sources,:] - positions[targets,np.newaxis,:]
+            dist_squared = np.einsum('ijk,ijk->ij', dist, dist)
+
+            with np.errstate(divide='ignore'):
+                inv_dist_cubed = dist_squared ** -1.5
+            inv_dist_cubed[dist_squared == 0] = 0
+
+            field[targets] += np.einsum(
+                    'ij,ijk->ik', masses[sources] * inv_dist_cubed, dist)
+            continue
+
+        # Approximate the node by its center of mass for every target that is 
+        # both far enough away and not inside the node itself.  (The second 
+        # condition only matters for large values of theta, but without it an 
+        # object could end up attracting itself.)
+
+        dist = node.center_of_mass - positions[targets]
+        dist_squared = np.einsum('ij,ij->i', dist, dist)
+
+        outside = np.any(
+                (positions[targets] < node.min_corner) |
+                (positions[targets] > node.max_corner), axis=1)
+        far = outside & (node.size**2 < theta**2 * dist_squared)
+
+        if np.any(far):
+            field[targets[far]] += (
+                    node.mass * dist[far] /
+                    dist_squared[far,np.newaxis] ** 1.5)
+
+        near = targets[~far]
+        if len(near):
+            stack.extend((child, near) for child in node.children)
+
+    return G * masses[:,np.newaxis] * field
+
+
+class QuadTree:
+    """
+    A node in the quadtree used by barnes_hut_forces().
+
+    Each node covers a square region of the field and knows the total mass and 
+    the center of mass of every object within that region.  Nodes containing 
+    no more than leaf_size objects aren't subdivided any further.
+    """
+
+    max_depth = 32
+
+    def __init__(self, positions, masses, leaf_size=8,
+            indices=None, min_corner=None, size=None, depth=0):
+        if indices is None:
+            indices = np.arange(len(positions))
+            min_corner = positions.min(axis=0)
+            size = max(np.ptp(positions, axis=0).max(), 1e-9)
+
+        self.indices = indices
+        self.min_corner = min_corner
+        self.max_corner = min_corner + size
+        self.size = size
+        self.mass = masses[indices].sum()
+        self.children = []
+
+        if self.mass > 0:
+            self.center_of_mass = masses[indices].dot(positions[indices]) / self.mass
+        else:
+            self.center_of_mass = positions[indices].mean(axis=0)
+
+        if len(indices) <= leaf_size or depth >= self.max_depth:
+            return
+
+        # Split the node into four quadrants and recurse into the ones that 
+        # contain at least one object.
+
+        half = size / 2
+        center = min_corner + half
+        right = positions[indices,0] >= center[0]
+        top = positions[indices,1] >= center[1]
+
+        for is_right in (False, True):
+            for is_top in (False, True):
+                in_quadrant = (right == is_right) & (top == is_top)
+                if not np.any(in_quadrant):
+                    continue
+
+                offset = np.array([half if is_right else 0, half if is_top else 0])
+                self.children.append(QuadTree(
+                        positions, masses, leaf_size,
+                        indices[in_quadrant],
+                        min_corner + offset,
+                        half,
+                        depth + 1,
+                ))
+
+    @property
+    def is_leaf(self):
+        return not self.children
+
@@ -1,9 +1,11 @@
 #!/usr/bin/env python3
 
 import os.path
-import kxg, pyglet, glooey, random
+import kxg, pyglet, glooey, random, time, collections
 from vecrec import Vector
 from . import world, tokens, messages
+from .profiling import PhaseTimer
+from .traffic import MessageLog
 
 pyglet.resource.path = [
         os.path.join(os.path.dirname(__file__), '..', 'resources'),
@@ -22,6 +24,7 @@ class Gui:
                 pyglet.resource.image('icon_64.png'),
         )
         self.batch = pyglet.graphics.Batch()
+        self.sprites = set()
 
         # Load the background color from a resource file.
 
@@ -67,6 +70,26 @@ class Gui:
         self.window.clear()
         self.batch.draw()
 
+    def add_sprite(self, image, position, layer):
+        """
+        Create a sprite in the main batch.  Sprites should be created with 
+        this method and deleted with `remove_sprite()`, so that the number of 
+        live sprites can be shown in the performance overlay.
+        """
+        sprite = pyglet.sprite.Sprite(
+                self.images[image],
+                x=position.x,
+                y=position.y,
+                batch=self.batch,
+                group=pyglet.graphics.OrderedGroup(layer),
+        )
+        self.sprites.add(sprite)
+        return sprite
+
+    def remove_sprite(self, sprite):
+        self.sprites.discard(sprite)
+        sprite.delete()
+
 
 class GuiActor (kxg.Actor):
     """
@@ -83,12 +106,14 @@ class GuiActor (kxg.Actor):
         self.player = None
         self.animations = []
         self.focus_point = Vector.null()
-        self.show_fps = False
-        self.fps_widget = pyglet.clock.ClockDisplay()
+        self.overlay = None
+        self.message_log = MessageLog()
+        self.predicted_shots = {}
 
     def on_setup_gui(self, gui):
         self.gui = gui
         self.gui.window.push_handlers(self)
+        self.overlay = PerfOverlay(self)
 
     def on_start_game(self, num_players):
         self.player = tokens.Player()
@@ -96,16 +121,29 @@ class GuiActor (kxg.Actor):
 
     def on_draw(self):
         self.gui.on_refresh_gui()
-        if self.show_fps:
-            self.fps_widget.draw()
 
     def on_update_game(self, dt):
-        for animation in self.animations:
+        self.confirm_predicted_shots()
+
+        for animation in list(self.animations):
             animation.on_update(dt)
 
+        self.overlay.on_update(dt)
+
     def on_key_press(self, symbol, modifiers):
         if symbol == pyglet.window.key.SPACE:
-            self.show_fps = not self.show_fps
+            self.overlay.toggle()
+
+        # Record the network cost of each type of message until 'M' is 
+        # pressed again, then print what was recorded.
+
+        if symbol == pyglet.window.key.M:
+            if self.message_log.is_attached:
+                self.message_log.detach()
+                self.message_log.dump()
+            else:
+                self.message_log.clear()
+                self.message_log.attach(self.world, [self])
 
     def on_mouse_press(self, x, y, button, modifiers):
         # Send a "ShootBullet" signal when the user left-clicks.
@@ -120,16 +158,53 @@ class GuiActor (kxg.Actor):
             bullet = tokens.Bullet(cannon, position, velocity)
 
             if self.player.can_shoot(bullet):
-                self >> messages.ShootBullet(bullet)
+                self.shoot(bullet)
             else:
                 kxg.info("Not enough arsenal to shoot bullet!")
 
+    def shoot(self, bullet):
+        """
+        Shoot the given bullet without waiting to hear back from the server.
+
+        The ShootBullet message is executed on this client as soon as it's 
+        sent, so the bullet appears right away, but until the server accepts 
+        it the bullet is only a prediction and is drawn faded.  If the server 
+        rejects it, kxg undoes the message and the bullet fades out instead 
+        of vanishing.
+        """
+        message = messages.ShootBullet(bullet)
+        self.predicted_shots[bullet] = message
+        self >> message
+        self.confirm_predicted_shots()
+
+    def confirm_predicted_shots(self):
+        for bullet, message in list(self.predicted_shots.items()):
+            if get_shot_status(message) == 'confirmed':
+                del self.predicted_shots[bullet]
+                if bullet.world is not None:
+                    bullet.get_extension(self).on_confirm()
+
     def on_mouse_motion(self, x, y, dx, dy):
         self.focus_point = Vector(x, y)
 
     @kxg.subscribe_to_message(messages.HitSomething)
     def on_hit_by_bullet(self, message):
         ExplosionAnimation(self, message.position)
+        self.overlay.count_message('hit')
+
+    @kxg.subscribe_to_message(messages.HitBatch)
+    def on_hit_batch(self, message):
+        for position in message.positions:
+            ExplosionAnimation(self, position)
+            self.overlay.count_message('hit')
+
+    @kxg.subscribe_to_undo_response(messages.ShootBullet)
+    def on_shot_rejected(self, message):
+        kxg.info("Server rejected shot: {message.bullet}")
+
+    @kxg.subscribe_to_message(messages.SyncWorlds)
+    def on_sync_worlds(self, message):
+        self.overlay.count_message('sync')
 
     @kxg.subscribe_to_message(messages.EndGame)
     def on_end_game(self, message):
@@ -153,21 +228,12 @@ class CannonExtension (kxg.TokenExtension):
     def on_add_to_world(self, world):
         self.create_arsenal(world)
 
-        self.base = pyglet.sprite.Sprite(
-                self.actor.gui.images['cannon-base'],
-                x=self.token.position.x,
-                y=self.token.position.y,
-                batch=self.actor.gui.batch,
-                group=pyglet.graphics.OrderedGroup(4),
-        )
+        self.base = self.actor.gui.add_sprite(
+                'cannon-base', self.token.position, 4)
+
         if self.token.player is self.actor.player:
-            self.muzzle = pyglet.sprite.Sprite(
-                    self.actor.gui.images['cannon-muzzle'],
-                    x=self.token.position.x,
-                    y=self.token.position.y,
-                    batch=self.actor.gui.batch,
-                    group=pyglet.graphics.OrderedGroup(3),
-            )
+            self.muzzle = self.actor.gui.add_sprite(
+                    'cannon-muzzle', self.token.position, 3)
 
     def create_arsenal(self, world):
         if self.token.player is not self.actor.player:
@@ -191,20 +257,10 @@ class CannonExtension (kxg.TokenExtension):
         self.arsenal_images = []
         for relative_position in arsenal_corner_positions:
             position = token_position + relative_position
-            empty_bullet = pyglet.sprite.Sprite(
-                        self.actor.gui.images['empty_bullet'],
-                        x=position.x,
-                        y=position.y,
-                        batch=self.actor.gui.batch,
-                        group=pyglet.graphics.OrderedGroup(5),
-            )
-            full_bullet = pyglet.sprite.Sprite(
-                        self.actor.gui.images['bullet_ours'],
-                        x=position.x,
-                        y=position.y,
-                        batch=self.actor.gui.batch,
-                        group=pyglet.graphics.OrderedGroup(5),
-            )
+            empty_bullet = self.actor.gui.add_sprite(
+                        'empty_bullet', position, 5)
+            full_bullet = self.actor.gui.add_sprite(
+                        'bullet_ours', position, 5)
             empty_bullet.visible = True
             full_bullet.visible = False
 
@@ -243,28 +299,55 @@ class FieldObjectExtension (kxg.TokenExtension):
 
     @kxg.watch_token
     def on_add_to_world(self, world):
-        self.sprite = pyglet.sprite.Sprite(
-                self.actor.gui.images[self.get_image()],
-                x=self.token.position.x,
-                y=self.token.position.y,
-                batch=self.actor.gui.batch,
-                group=pyglet.graphics.OrderedGroup(1),
-        )
+        self.sprite = self.actor.gui.add_sprite(
+                self.get_image(), self.token.position, 1)
 
     def get_image(self):
         return self.image
 
     @kxg.watch_token
     def on_update_game(self, delta_t):
-        self.sprite.position = self.token.position
+        # Extrapolate over the time that the physics engine hasn't simulated 
+        # yet, so that objects move smoothly between physics steps, and draw 
+        # objects that were just corrected by a sync where they used to be.
+        world = self.token.world
+        self.sprite.position = self.token.position \
+                + world.physics_lag * self.token.velocity \
+                + world.visual_offset_of(self.token)
 
     @kxg.watch_token
     def on_remove_from_world(self):
-        self.sprite.delete()
+        self.actor.gui.remove_sprite(self.sprite)
 
 
 class BulletExtension (FieldObjectExtension):
 
+    # How opaque bullets that the server hasn't accepted yet are drawn, out of 
+    # 255.
+
+    predicted_opacity = 128
+
+    @kxg.watch_token
+    def on_add_to_world(self, world):
+        super().on_add_to_world(world)
+        if self.token in self.actor.predicted_shots:
+            self.sprite.opacity = self.predicted_opacity
+
+    def on_confirm(self):
+        self.sprite.opacity = 255
+
+    @kxg.watch_token
+    def on_remove_from_world(self):
+        message = self.actor.predicted_shots.pop(self.token, None)
+
+        # If the server rejected the shot, let the bullet fade out where it 
+        # was last drawn, rather than having it blink out of existence.
+
+        if message and get_shot_status(message) == 'rejected':
+            FadeAnimation(self.actor, self.sprite, self.token.velocity)
+        else:
+            super().on_remove_from_world()
+
     def get_image(self):
         if self.token.cannon.player is self.actor.player:
             return 'bullet_ours'
@@ -297,13 +380,8 @@ class ExplosionAnimation:
         self.num_images = 3
 
         self.explosion_sprites = [
-                pyglet.sprite.Sprite(
-                    self.actor.gui.images['explosion-'+str(i+1)],
-                    x=self.position.x,
-                    y=self.position.y,
-                    batch=self.actor.gui.batch,
-                    group=pyglet.graphics.OrderedGroup(-(i+1)),
-                )
+                self.actor.gui.add_sprite(
+                    'explosion-'+str(i+1), self.position, -(i+1))
                 for i in range(self.num_images)
         ]
         self.rotation_rates = [
@@ -322,7 +400,217 @@ class ExplosionAnimation:
         if sprite.scale < 0:
             self.actor.animations.remove(self)
             for sprite in self.explosion_sprites:
-                sprite.delete()
+                self.actor.gui.remove_sprite(sprite)
+
+
+class FadeAnimation:
+    """
+    Fade out a sprite that no longer belongs to a token, letting it coast 
+    along at the given velocity, then delete it.
+    """
+    duration = 0.25
+
+    def __init__(self, actor, sprite, velocity):
+        self.actor = actor; self.actor.animations.append(self)
+        self.sprite = sprite
+        self.velocity = velocity
+        self.opacity = sprite.opacity
+        self.elapsed = 0
+
+    def on_update(self, dt):
+        self.elapsed += dt
+
+        if self.elapsed >= self.duration:
+            self.actor.animations.remove(self)
+            self.actor.gui.remove_sprite(self.sprite)
+            return
+
+        position = Vector(self.sprite.x, self.sprite.y) + dt * self.velocity
+        self.sprite.position = position.tuple
+        self.sprite.opacity = self.opacity * (1 - self.elapsed / self.duration)
+
+
+def get_shot_status(message):
+    """
+    Return 'pending' if the server hasn't responded to the given ShootBullet 
+    message yet, otherwise 'confirmed' or 'rejected'.  Messages that weren't 
+    sent through a ClientForum (e.g. in a single-player game) are 
+    authoritative as soon as they're executed, so they're always confirmed.
+    """
+    # kxg (as of 0.2.0) has no public way to find out how the server responded 
+    # to a message: ClientForum calls the undo and sync response callbacks, 
+    # but nothing for messages that were accepted.  So this reads the private 
+    # attributes that ClientForum sets on the messages it sends.  Nothing else 
+    # in the game touches them, so this is the only thing to update if kxg 
+    # changes.
+
+    if not hasattr(message, '_server_response_id'):
+        return 'confirmed'
+
+    response = message._get_server_response()
+
+    if response is None:
+        return 'pending'
+    elif response.undo_needed:
+        return 'rejected'
+    else:
+        return 'confirmed'
+
+
+class PerfOverlay:
+    """
+    Show how long each frame takes and what the game is spending it on.
+
+    The overlay has a graph of the most recent frame times (with lines at 60 
+    and 30 fps for reference) and a few lines of text giving the split between 
+    simulation and rendering, the number of physics steps per frame, the number 
+    of field objects and sprites, and how often sync and hit messages are 
+    arriving.  Everything is drawn through the main batch, and the text is 
+    only laid out a few times a second, because relayout is the expensive part 
+    of drawing a label.
+
+    The simulation and render times come from a PhaseTimer that's only 
+    attached while the overlay is visible, so the overlay costs nothing while 
+    it's hidden.
+    """
+    num_samples = 120
+    bar_width = 2
+    pixels_per_ms = 3
+    text_update_interval = 0.25
+    message_rate_window = 1.0
+    corner = Vector(10, 10)
+    layer = 20
+
+    def __init__(self, actor):
+        self.actor = actor
+        self.timer = PhaseTimer(history_length=self.num_samples)
+        self.frame_times = collections.deque(
+                [0] * self.num_samples, maxlen=self.num_samples)
+        self.message_times = collections.defaultdict(collections.deque)
+        self.time_since_text_update = 0
+        self.bars = None
+        self.guides = None
+        self.label = None
+
+    @property
+    def is_visible(self):
+        return self.label is not None
+
+    def toggle(self):
+        if self.is_visible:
+            self.hide()
+        else:
+            self.show()
+
+    def show(self):
+        gui = self.actor.gui
+        group = pyglet.graphics.OrderedGroup(self.layer)
+        x0, y0 = self.corner
+        width = self.num_samples * self.bar_width
+
+        self.timer.clear()
+        self.timer.attach(self.actor.world, [self.actor], gui=gui)
+
+        self.bars = gui.batch.add(
+                2 * self.num_samples, pyglet.gl.GL_LINES, group,
+                ('v2f/stream', [0] * 4 * self.num_samples),
+                ('c3B/stream', [255] * 6 * self.num_samples),
+        )
+        self.guides = gui.batch.add(
+                4, pyglet.gl.GL_LINES, group,
+                ('v2f/static', [
+                    x0, y0 + 1000 / 60 * self.pixels_per_ms,
+                    x0 + width, y0 + 1000 / 60 * self.pixels_per_ms,
+                    x0, y0 + 1000 / 30 * self.pixels_per_ms,
+                    x0 + width, y0 + 1000 / 30 * self.pixels_per_ms,
+                ]),
+                ('c3B/static', [128] * 12),
+        )
+        self.label = pyglet.text.Label(
+                '',
+                font_name='Monospace',
+                font_size=9,
+                x=x0, y=y0 + 1000 / 30 * self.pixels_per_ms + 10,
+                width=300, multiline=True,
+                anchor_x='left', anchor_y='bottom',
+                batch=gui.batch,
+                group=group,
+        )
+        self.update_text()
+
+    def hide(self):
+        self.timer.detach()
+        self.bars.delete()
+        self.guides.delete()
+        self.label.delete()
+        self.bars = self.guides = self.label = None
+        self.message_times.clear()
+
+    def count_message(self, kind):
+        if self.is_visible:
+            self.message_times[kind].append(time.perf_counter())
+
+    def message_rate(self, kind):
+        times = self.message_times[kind]
+        cutoff = time.perf_counter() - self.message_rate_window
+        while times and times[0] < cutoff:
+            times.popleft()
+        return len(times) / self.message_rate_window
+
+    def on_update(self, dt):
+        if not self.is_visible:
+            return
 
+        self.frame_times.append(dt)
+        self.update_bars()
 
+        self.time_since_text_update += dt
+        if self.time_since_text_update > self.text_update_interval:
+            self.update_text()
 
+    def update_bars(self):
+        x0, y0 = self.corner
+        vertices = []
+        colors = []
+
+        for i, frame_time in enumerate(self.frame_times):
+            x = x0 + i * self.bar_width
+            y = y0 + 1000 * frame_time * self.pixels_per_ms
+            vertices += [x, y0, x, y]
+
+            # Color each bar by whether it made 60 fps, 30 fps, or neither.
+
+            if frame_time <= 1 / 60:
+                color = (80, 200, 80)
+            elif frame_time <= 1 / 30:
+                color = (230, 200, 60)
+            else:
+                color = (230, 70, 70)
+            colors += color * 2
+
+        self.bars.vertices[:] = vertices
+        self.bars.colors[:] = colors
+
+    def update_text(self):
+        self.time_since_text_update = 0
+
+        world = self.actor.world
+        report = self.timer.report()
+        frame_time = sum(self.frame_times) / len(self.frame_times)
+        sim_time = report.get('world', {}).get('mean', 0)
+        render_time = report.get('render', {}).get('mean', 0)
+        steps = world.physics_step_history
+        steps_per_frame = sum(steps) / len(steps) if steps else 0
+
+        self.label.text = '\n'.join([
+            "frame:   {:5.1f} ms ({:.0f} fps)".format(
+                1e3 * frame_time, 1 / frame_time if frame_time else 0),
+            "sim:     {:5.1f} ms".format(1e3 * sim_time),
+            "render:  {:5.1f} ms".format(1e3 * render_time),
+            "steps:   {:5.1f} / frame".format(steps_per_frame),
+            "objects: {} bullets, {} targets, {} obstacles".format(
+                len(world.bullets), len(world.targets), len(world.obstacles)),
+            "sprites: {}".format(len(self.actor.gui.sprites)),
+            "sync:    {:5.1f} / sec".format(self.message_rate('sync')),
+            "hits:    {:5.1f} / sec".format(self.message_rate('hit')),
+        ])
@@ -0,0 +1,263 @@
+#!/usr/bin/env python3
+
+"""
+Play matches between AIs without a window.
+
+The game is driven by a fixed simulated time step rather than by the clock, so
+matches run as fast as the CPU allows.  The gui module is never imported, so
+no window is opened and glooey isn't needed.  (kxg itself still imports the
+pyglet package, but nothing here touches pyglet's windowing or GL code.)
+
+If a seed is given, the match is completely deterministic: the same seed
+produces a bit-identical stream of messages and the same final state, as long
+as each match is played in a new process (see check_determinism).  Use
+`--check-determinism` to verify this by playing each match twice and comparing
+digests of the two runs.
+
+Usage:
+    python -m pie_in_the_sky.headless [--ais N] [--matches N] [--dt SECONDS]
+                                      [--seed N] [--check-determinism]
+                                      [--profile] [--messages] [--record FILE]
+"""
+
+import kxg, time, collections, hashlib, multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from .world import World
+from .referee import Referee
+from .ai import AiActor
+from .profiling import PhaseTimer, print_report
+from . import traffic, replay
+
+MatchResult = collections.namedtuple('MatchResult', [
+    'winner',           # index of the winning AI, or None if time ran out
+    'num_frames',       # number of updates that were simulated
+    'simulated_time',   # seconds of game time that were simulated
+    'wall_time',        # seconds of real time the match took
+    'frames_per_sec',   # simulation throughput
+    'digest',           # hash of the message stream and final state, or None
+    'phase_times',      # PhaseTimer.report() for the match, or None
+    'message_stats',    # MessageLog.report() for the match, or None
+    'sync_metrics',     # Referee.sync_metrics() at the end of the match
+])
+
+Match = collections.namedtuple('Match', [
+    'world', 'referee', 'ais', 'forum', 'theater',
+])
+
+def setup_match(num_ais=2, world_cls=World, seed=None, forum=None, referee=None):
+    """
+    Create the world, the referee, the AIs, and the theater needed to play a
+    headless match, but don't start playing it yet.  Call `theater.update(dt)`
+    to advance the match; the first update starts the game.
+    """
+    world = world_cls(seed=seed)
+    referee = referee or Referee()
+    ais = [AiActor() for i in range(num_ais)]
+    forum = forum or kxg.Forum()
+
+    stage = kxg.GameStage(world, forum, [referee] + ais)
+    theater = kxg.Theater(stage)
+
+    return Match(world, referee, ais, forum, theater)
+
+def play_match(num_ais=2, dt=1/50, max_simulated_time=600, world_cls=World,
+        seed=None, digest=False, profile=False, log_messages=False,
+        record=None):
+    """
+    Play a single match between the given number of AIs and return a
+    MatchResult.
+
+    Each update advances the game by exactly `dt` seconds.  If nobody has won
+    after `max_simulated_time` seconds, the match is abandoned and the winner
+    is reported as None.  The seed is used to initialize the world's random
+    number generator.  If `digest` is true, every message is serialized as it
+    is executed and a hash of the message stream and the final state of the
+    world is included in the result.  If `profile` is true, each phase of the
+    game loop is timed and the percentiles are included in the result.  If 
+    `log_messages` is true, the size, rate, and latency of each type of 
+    message is recorded and included in the result.  If `record` is a path, 
+    the match is recorded there so it can be played back with the replay 
+    module.
+    """
+    forum = DigestForum() if digest else kxg.Forum()
+    match = setup_match(num_ais, world_cls, seed, forum)
+    world, theater = match.world, match.theater
+
+    if profile:
+        timer = PhaseTimer(history_length=int(max_simulated_time / dt) + 1)
+        timer.attach(world, [match.referee] + match.ais, forum)
+
+    if log_messages:
+        message_log = traffic.MessageLog()
+        message_log.attach(world, [match.referee] + match.ais)
+
+    if record:
+        recorder = replay.ReplayRecorder(record)
+        recorder.attach(world, [match.referee] + match.ais)
+
+    num_frames = 0
+    start_time = time.perf_counter()
+
+    while not theater.is_finished:
+        if num_frames * dt >= max_simulated_time:
+            break
+        theater.update(dt)
+        num_frames += 1
+
+    wall_time = time.perf_counter() - start_time
+
+    if record:
+        recorder.close()
+
+    winner = None
+    for i, ai in enumerate(match.ais):
+        if world.winner is not None and world.winner is ai.player:
+            winner = i
+
+    return MatchResult(
+            winner=winner,
+            num_frames=num_frames,
+            simulated_time=num_frames * dt,
+            wall_time=wall_time,
+            frames_per_sec=num_frames / wall_time if wall_time else float('inf'),
+            digest=forum.hexdigest(world) if digest else None,
+            phase_times=timer.report() if profile else None,
+            message_stats=message_log.report() if log_messages else None,
+            sync_metrics=match.referee.sync_metrics(),
+    )
+
+def check_determinism(num_ais=2, dt=1/50, max_simulated_time=600, seed=0):
+    """
+    Play the same seeded match twice and return the two results.  If the game 
+    is deterministic, the digests of the two results will be identical.
+
+    Each match is played in a freshly started process.  The physics engine 
+    keeps the contacts between shapes in a hash table keyed by their memory 
+    addresses, so the order in which it resolves collisions (and therefore 
+    the rounding of the results) depends on what was allocated before the 
+    match started.  Two matches played in the same process can differ, even 
+    though the same match played in two new processes doesn't.
+    """
+    context = multiprocessing.get_context('spawn')
+    results = []
+
+    for i in range(2):
+        with ProcessPoolExecutor(1, mp_context=context) as executor:
+            future = executor.submit(play_match,
+                    num_ais, dt, max_simulated_time, seed=seed, digest=True)
+            results.append(future.result())
+
+    return results
+
+def digest_world(world):
+    """
+    Return a hashable summary of everything that matters about the state of 
+    the world: the positions and velocities of the field objects, the players' 
+    arsenals and targets, and the winner.
+    """
+    field_objects = tuple(
+            (obj.id, type(obj).__name__,
+                tuple(obj.body.position), tuple(obj.body.velocity))
+            for obj in world.field_objects
+    )
+    players = tuple(
+            (player.id, player.arsenal, player._arsenal,
+                tuple(target.id for target in player.targets))
+            for player in world.players
+    )
+    winner = world.winner.id if world.winner else None
+    return field_objects, players, winner
+
+
+class DigestForum (kxg.Forum):
+    """
+    A forum that hashes every message it executes.
+
+    Messages are serialized the same way they would be for the network, so 
+    any difference in what would be sent between two runs shows up as a 
+    difference in the digest.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.hash = hashlib.sha256()
+        self.serializer = None
+
+    def connect_everyone(self, world, actors):
+        super().connect_everyone(world, actors)
+        self.serializer = kxg.MessageSerializer(world)
+
+    def execute_message(self, message):
+        self.hash.update(self.serializer.pack(message))
+        super().execute_message(message)
+
+    def hexdigest(self, world):
+        digest = self.hash.copy()
+        digest.update(repr(digest_world(world)).encode())
+        return digest.hexdigest()
+
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(
+            description="Play AI-vs-AI matches without a window.")
+    parser.add_argument('--ais', type=int, default=2,
+            help="number of AIs in each match")
+    parser.add_argument('--matches', type=int, default=1,
+            help="number of matches to play")
+    parser.add_argument('--dt', type=float, default=1/50,
+            help="simulated seconds per update")
+    parser.add_argument('--max-time', type=float, default=600,
+            help="simulated seconds before a match is abandoned")
+    parser.add_argument('--seed', type=int, default=None,
+            help="seed for the first match; each match after uses the next integer")
+    parser.add_argument('--check-determinism', action='store_true',
+            help="play each match twice and make sure the results are identical")
+    parser.add_argument('--profile', action='store_true',
+            help="time each phase of the game loop and print the percentiles")
+    parser.add_argument('--messages', action='store_true',
+            help="print the size, rate, and latency of each type of message")
+    parser.add_argument('--record', metavar='FILE',
+            help="record each match to FILE ('{}' is replaced by the match number)")
+    args = parser.parse_args()
+
+    if args.check_determinism:
+        seed = 0 if args.seed is None else args.seed
+        for i in range(args.matches):
+            first, second = check_determinism(
+                    args.ais, args.dt, args.max_time, seed + i)
+            same = first.digest == second.digest
+            print("seed {}: {} ({})".format(
+                seed + i, 'deterministic' if same else 'NOT DETERMINISTIC',
+                first.digest[:12]))
+            if not same:
+                raise SystemExit(1)
+        return
+
+    for i in range(args.matches):
+        seed = None if args.seed is None else args.seed + i
+        result = play_match(
+                args.ais, args.dt, args.max_time, seed=seed,
+                profile=args.profile, log_messages=args.messages,
+                record=args.record and args.record.format(i))
+        winner = 'none' if result.winner is None else 'AI {}'.format(result.winner)
+        print("match {}: winner={}, frames={}, simulated={:.1f}s, "
+              "wall={:.2f}s, fps={:.0f}".format(
+            i, winner, result.num_frames, result.simulated_time,
+            result.wall_time, result.frames_per_sec))
+
+        if result.phase_times:
+            print()
+            print_report(result.phase_times)
+            print()
+
+        if result.message_stats:
+            print()
+            traffic.print_report(result.message_stats)
+            print("sync rate: {:.2f}/sec".format(result.sync_metrics['sync_rate']))
+            print()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,117 @@
+#!/usr/bin/env python3
+
+"""
+Helpers shared by the tools that observe a running game (the PhaseTimer, the
+MessageLog, and the ReplayRecorder).
+
+These tools work by hooking methods of the world, the actors, and the forum
+when they're attached, so they cost nothing until then.  Several tools can
+hook the same method at the same time, and they can be detached in any
+order: each hooked method keeps a chain of wrappers, and the original method
+is only put back once the last wrapper has been removed.
+"""
+
+import functools
+
+class Hooks:
+    """
+    The hooks installed by one tool, so they can all be removed at once.
+    """
+
+    def __init__(self):
+        self._hooks = []
+
+    def __bool__(self):
+        return bool(self._hooks)
+
+    def add(self, obj, name, wrapper):
+        """
+        Hook the given method.  From now on, calling the method will call
+        `wrapper(method, *args, **kwargs)`, where `method` is whatever would
+        have been called otherwise.
+        """
+        method = obj.__dict__.get(name)
+        if not isinstance(method, HookedMethod):
+            method = HookedMethod(obj, name)
+            setattr(obj, name, method)
+
+        method.add(wrapper)
+        self._hooks.append((method, wrapper))
+
+    def remove_all(self):
+        for method, wrapper in reversed(self._hooks):
+            method.remove(wrapper)
+        self._hooks = []
+
+
+class HookedMethod:
+    """
+    Stand in for a method that one or more wrappers have been hooked into.
+    Wrappers added later are called first.
+    """
+
+    def __init__(self, obj, name):
+        self.obj = obj
+        self.name = name
+        self.original = obj.__dict__.get(name)
+        self.method = getattr(obj, name)
+        self.wrappers = []
+        self._call = self.method
+
+    def __call__(self, *args, **kwargs):
+        return self._call(*args, **kwargs)
+
+    def add(self, wrapper):
+        self.wrappers.append(wrapper)
+        self._chain_wrappers()
+
+    def remove(self, wrapper):
+        self.wrappers = [x for x in self.wrappers if x is not wrapper]
+        self._chain_wrappers()
+
+        if self.wrappers or self.obj.__dict__.get(self.name) is not self:
+            return
+
+        if self.original is None:
+            delattr(self.obj, self.name)
+        else:
+            setattr(self.obj, self.name, self.original)
+
+    def _chain_wrappers(self):
+        call = self.method
+        for wrapper in self.wrappers:
+            call = functools.partial(wrapper, call)
+        self._call = call
+
+
+def percentile(samples, percent):
+    """
+    Return the given percentile of the given samples, which must already be
+    sorted.  Returns 0 if there aren't any samples.
+    """
+    if not samples:
+        return 0
+    index = min(int(len(samples) * percent / 100), len(samples) - 1)
+    return samples[index]
+
+def print_table(report, title, columns, sort_key, file=None):
+    """
+    Print a table with one row for each entry in the given report (a
+    dictionary mapping names to dictionaries of statistics).  Each column is
+    a (heading, key, format) tuple, where the format is applied to
+    `stats[key]`.  Rows are ordered by `sort_key(stats)`.
+    """
+    width = max([len(title)] + [len(name) for name in report])
+
+    print('  '.join(
+        ['{:<{}s}'.format(title, width)] +
+        ['{:>9s}'.format(heading) for heading, key, format in columns]),
+        file=file)
+
+    for name in sorted(report, key=lambda x: sort_key(report[x])):
+        stats = report[name]
+        print('  '.join(
+            ['{:<{}s}'.format(name, width)] +
+            ['{:>9s}'.format(format.format(stats[key]))
+                for heading, key, format in columns]),
+            file=file)
@@ -0,0 +1,139 @@
+#!/usr/bin/env python3
+
+"""
+Draw the field objects by interpolating between the snapshots the referee
+sends, instead of simulating them.
+
+This is what thin clients do (see World.thin_client).  Snapshots don't arrive
+at perfectly regular intervals, because the network delivers some packets
+faster than others, so they're kept in a jitter buffer and played back
+`delay` seconds behind the newest one.  As long as the jitter is smaller than
+the delay, there's always a snapshot on either side of the playback time to
+interpolate between.  If the snapshots stop coming, the objects are carried
+forward at their last known velocities for a short while before they stop.
+"""
+
+import collections
+import numpy as np
+
+Snapshot = collections.namedtuple('Snapshot', 'time, ids, positions, velocities')
+
+class SnapshotBuffer:
+    """
+    Keep the most recent snapshots of the field objects, and interpolate
+    between them at a playback time that trails the newest snapshot.
+
+    The playback clock normally runs at the same rate as the game, but it's
+    sped up or slowed down by as much as `max_clock_adjustment` (as a fraction
+    of the time step) to keep it `delay` seconds behind the newest snapshot,
+    so that changes in latency are absorbed gradually rather than making
+    everything jump.  If it falls more than `max_clock_error` seconds out of
+    place (e.g. after a long stall), it's reset outright.
+
+    Objects are never extrapolated more than `max_extrapolation` seconds 
+    beyond the snapshots in the buffer.
+    """
+    max_clock_adjustment = 0.1
+    max_clock_error = 0.5
+    max_extrapolation = 0.25
+
+    def __init__(self, delay=0.1, capacity=32):
+        self.delay = delay
+        self.snapshots = collections.deque(maxlen=capacity)
+        self.playback_time = None
+
+    def __len__(self):
+        return len(self.snapshots)
+
+    def add(self, time, ids, positions, velocities):
+        """
+        Add a snapshot taken by the referee at the given game time.  Snapshots
+        that are older than the newest one in the buffer arrived out of order,
+        and are dropped.
+        """
+        if self.snapshots and time <= self.snapshots[-1].time:
+            return
+
+        # Sort the objects by id, so they can be matched up between snapshots
+        # with a binary search.
+
+        order = np.argsort(ids)
+        self.snapshots.append(Snapshot(
+                time,
+                np.asarray(ids)[order],
+                np.array(positions, dtype=float)[order],
+                np.array(velocities, dtype=float)[order],
+        ))
+
+    def clear(self):
+        self.snapshots.clear()
+        self.playback_time = None
+
+    def advance(self, dt):
+        """
+        Move the playback time forward by the given time step, nudging it
+        toward its target, and forget the snapshots it's left behind.
+        """
+        if not self.snapshots:
+            return
+
+        target = self.snapshots[-1].time - self.delay
+
+        if self.playback_time is None:
+            self.playback_time = target
+        else:
+            self.playback_time += dt
+            error = target - self.playback_time
+
+            if abs(error) > self.max_clock_error:
+                self.playback_time = target
+            else:
+                limit = self.max_clock_adjustment * dt
+                self.playback_time += min(max(error, -limit), limit)
+
+        # Keep the newest snapshot at or before the playback time, since it's
+        # needed to interpolate up to the next one.
+
+        while len(self.snapshots) > 1 and \
+                self.snapshots[1].time <= self.playback_time:
+            self.snapshots.popleft()
+
+    def sample(self):
+        """
+        Return the ids, positions, and velocities of the objects at the
+        current playback time, or None if there aren't any snapshots yet.
+        Objects in the newer of the two snapshots being interpolated between
+        are included; objects that weren't in the older snapshot yet are
+        placed by extrapolating backward from the newer one.
+        """
+        if not self.snapshots:
+            return None
+
+        t = self.playback_time
+        before = self.snapshots[0]
+
+        if len(self.snapshots) == 1 or t <= before.time:
+            elapsed = min(max(t - before.time, -self.max_extrapolation),
+                    self.max_extrapolation)
+            return before.ids, \
+                   before.positions + elapsed * before.velocities, \
+                   before.velocities
+
+        after = self.snapshots[1]
+        alpha = (t - before.time) / (after.time - before.time)
+
+        start_positions = after.positions - \
+                (after.time - before.time) * after.velocities
+        start_velocities = after.velocities.copy()
+
+        if len(before.ids):
+            index = np.searchsorted(before.ids, after.ids)
+            index = np.minimum(index, len(before.ids) - 1)
+            found = before.ids[index] == after.ids
+            start_positions[found] = before.positions[index[found]]
+            start_velocities[found] = before.velocities[index[found]]
+
+        positions = start_positions + alpha * (after.positions - start_positions)
+        velocities = start_velocities + alpha * (after.velocities - start_velocities)
+
+        return after.ids, positions, velocities
@@ -1,6 +1,6 @@
 
-import kxg, random
-from . import tokens
+import kxg
+from . import packing, tokens
 
 class StartGame (kxg.Message):
     """
@@ -12,19 +12,19 @@ class StartGame (kxg.Message):
         field = world.field
 
         def random_position():
-            return field.center + Vector.random(0.4*field.height)
+            return field.center + world.random_vector(0.4*field.height)
         def random_velocity():
-            return Vector.random(50)
+            return world.random_vector(50)
 
         # Create a few obstacles in the same way.
 
         self.obstacles = [
                 tokens.Obstacle(
                     Vector(
-                        random.randrange(field.left + 100, field.center_x),
-                        random.randrange(field.bottom + 100, field.top - 100),
+                        world.random.randrange(field.left + 100, field.center_x),
+                        world.random.randrange(field.bottom + 100, field.top - 100),
                     ),
-                    Vector.random(10))
+                    world.random_vector(10))
                 for i in range(2)
         ]
 
@@ -70,9 +70,7 @@ class StartGame (kxg.Message):
             raise kxg.MessageCheck("targets already exists")
 
     def on_execute(self, world):
-        world.targets = self.targets
         world.final_target = self.final_target
-        world.obstacles = self.obstacles
 
         for cannon in self.cannons:
             player = cannon.player
@@ -119,28 +117,91 @@ class ShootBullet (kxg.Message):
             raise kxg.MessageCheck("player does not have enough bullet capacity.")
 
     def on_execute(self, world):
-        world.bullets.append(self.bullet)
         self.player.spend_arsenal(self.bullet)
 
+    def on_undo(self, world):
+        # Clients shoot as soon as the mouse is clicked, without waiting for 
+        # the server, so this is called if the server turns out not to agree 
+        # that the player had enough arsenal.  kxg already takes the bullet 
+        # back out of the world; give the player back what it cost.
+        self.player.refund_arsenal(self.bullet)
+
 
 class SyncWorlds (kxg.Message):
     """
     Synchronize game objects.
+
+    The positions and velocities are packed into flat binary buffers (see the 
+    packing module) along with the ids of the tokens they belong to, rather 
+    than being pickled object by object.  Objects that have been removed from 
+    the world by the time the message is executed are skipped.  Corrections 
+    are smoothed over on screen if the world's `sync_smoothing` is enabled.
+
+    The world the referee runs in ignores the message, and thin clients 
+    don't apply the state directly.  Instead, they add it to their snapshot 
+    buffers, using the game time the message was made at.
     """
 
-    def __init__(self, world):
-        self.state = {
-                token: (token.position.xy, token.velocity.xy)
-                for token in world.field_objects
-        }
+    def __init__(self, world, encoding='float32'):
+        self.pack(world, world.field_objects, encoding)
+
+    def pack(self, world, tokens, encoding):
+        if world.field_state.is_stale(world.field_objects):
+            world.update_field_state()
+
+        state = world.field_state
+        rows = [state.rows[token] for token in tokens]
+
+        self.time = world.elapsed_time
+        self.encoding = encoding
+        self.token_ids, self.buffer = packing.pack_state(
+                [token.id for token in tokens],
+                state.positions[rows],
+                state.velocities[rows],
+                world.field,
+                encoding,
+        )
 
     def on_check(self, world):
         if not self.was_sent_by_referee():
             raise kxg.MessageCheck('sync must be sent by referee')
 
     def on_execute(self, world):
-        for token in self.state:
-            token.body.position, token.body.velocity = self.state[token]
+        # The referee's world is where the state came from, so it's already 
+        # in sync.  Writing the state back would only round it (or quantize 
+        # and clip it, with the 'int16' encoding).
+
+        if not world.has_referee:
+            self.apply(world)
+
+    def apply(self, world):
+        ids, positions, velocities = packing.unpack_state(
+                self.token_ids, self.buffer, world.field, self.encoding)
+
+        if world.is_thin_client:
+            world.snapshot_buffer.add(self.time, ids, positions, velocities)
+            return
+
+        for id, position, velocity in zip(
+                ids.tolist(), positions.tolist(), velocities.tolist()):
+            try:
+                token = world.get_token(id)
+            except (KeyError, IndexError):
+                continue
+            world.correct_field_object(token, position, velocity)
+
+        world.update_field_state()
+
+
+class SyncDelta (SyncWorlds):
+    """
+    Synchronize only the given game objects.  The referee uses this to resend 
+    just the objects that have drifted from where the clients would expect 
+    them to be, in between full SyncWorlds keyframes.
+    """
+
+    def __init__(self, world, tokens, encoding='float32'):
+        self.pack(world, tokens, encoding)
 
 
 class HitSomething (kxg.Message):
@@ -212,13 +273,47 @@ class HitObstacle (HitSomething):
         yield self.bullet
 
 
+class HitBatch (kxg.Message):
+    """
+    Carry out a number of hits at once.
+
+    The referee collects all the collisions that happen in a frame and sends 
+    them in one of these, rather than sending each hit as a separate message, 
+    so that there's only one message to check, execute, and send over the 
+    network.  The hits are executed in order.
+    """
+
+    def __init__(self, hits):
+        self.hits = hits
+
+    @property
+    def positions(self):
+        return [hit.position for hit in self.hits]
+
+    def tokens_to_remove(self):
+        for hit in self.hits:
+            yield from hit.tokens_to_remove()
+
+    def on_check(self, world):
+        if not self.was_sent_by_referee():
+            raise kxg.MessageCheck("hits must be reported by the referee")
+
+        removed = list(self.tokens_to_remove())
+        if len(set(removed)) != len(removed):
+            raise kxg.MessageCheck("hit batch removes the same token twice")
+
+    def on_execute(self, world):
+        for hit in self.hits:
+            hit.on_execute(world)
+
+
 class EndGame (kxg.Message):
 
     def __init__(self, winner):
         self.winner = winner
 
     def on_check(self, world):
-        if world.is_game_over():
+        if world.has_game_ended():
             raise kxg.MessageCheck("game already over")
 
     def on_execute(self, world):
@@ -0,0 +1,180 @@
+#!/usr/bin/env python3
+
+"""
+Time each phase of the game loop.
+
+A PhaseTimer works by hooking the methods that make up each phase of the
+game loop (see the instrumentation module), so nothing at all is timed (and
+nothing costs anything) until the timer is attached, and everything goes back
+to normal when it's detached.
+"""
+
+import time, json, collections
+from .instrumentation import Hooks, percentile, print_table
+
+class PhaseTimer:
+    """
+    Keep rolling statistics on how long each phase of the game loop takes.
+
+    The time spent in each phase is added up over the course of a frame, and
+    the totals from the most recent `history_length` frames are kept, from
+    which percentiles can be calculated on demand.  A frame ends whenever the
+    world finishes updating.
+
+    Note that some phases happen inside of others.  For example, collision
+    callbacks happen while the physics engine is being stepped, and messages
+    can be executed from almost anywhere.  The time for a nested phase is
+    included in the time for the phase that contains it.
+    """
+
+    def __init__(self, history_length=300):
+        self.history_length = history_length
+        self.history = collections.defaultdict(
+                lambda: collections.deque(maxlen=history_length))
+        self.num_frames = 0
+        self._current_frame = collections.defaultdict(float)
+        self._hooks = Hooks()
+        self._referees = []
+
+    @property
+    def is_attached(self):
+        return bool(self._hooks)
+
+    def attach(self, world, actors=(), forum=None, gui=None):
+        """
+        Start timing the given game objects.  The referee should be attached
+        before the game starts, because otherwise its collision callbacks
+        will have already been handed to the physics engine.
+        """
+        from .referee import Referee
+
+        self.detach()
+
+        self.wrap(world, 'update_tokens', 'token_updates')
+        self.wrap(world, 'update_players', 'recharge_arsenal')
+        self.wrap(world, 'reset_forces', 'reset_forces')
+        self.wrap(world, 'apply_gravity', 'gravity')
+        self.wrap(world, 'step_physics', 'physics')
+        self.wrap(world, 'update_field_state', 'field_state')
+        self.wrap(world, 'decay_visual_offsets', 'sync_smoothing')
+        self.wrap(world, 'interpolate_field_objects', 'interpolation')
+        self.wrap(world, 'on_update_game', 'world', end_frame=True)
+
+        for actor in actors:
+            name = 'actor:' + actor.__class__.__name__
+            self.wrap(actor, 'on_update_game', name)
+
+            if isinstance(actor, Referee):
+                for method in 'on_hit_bullet', 'on_hit_target', 'on_hit_obstacle', \
+                        'dispatch_collisions':
+                    self.wrap(actor, method, 'collisions')
+                self._referees.append(actor)
+
+                # Re-register the collision handlers, in case the physics
+                # engine already has references to the untimed methods.
+
+                if actor.world is not None:
+                    actor.add_collision_handlers()
+
+        if forum is not None:
+            self.wrap(forum, 'execute_message', 'messages')
+
+        if gui is not None:
+            self.wrap(gui, 'on_refresh_gui', 'render')
+
+    def detach(self):
+        """
+        Stop timing anything and restore all the original methods.
+        """
+        self._hooks.remove_all()
+
+        for referee in self._referees:
+            if referee.world is not None:
+                referee.add_collision_handlers()
+
+        self._referees = []
+
+    def wrap(self, obj, name, phase, end_frame=False):
+        """
+        Hook the given method so that how long it takes is added to the given
+        phase.
+        """
+        current_frame = self._current_frame
+        clock = time.perf_counter
+
+        def timed_method(method, *args, **kwargs):
+            start = clock()
+            try:
+                return method(*args, **kwargs)
+            finally:
+                current_frame[phase] += clock() - start
+                if end_frame:
+                    self.end_frame()
+
+        self._hooks.add(obj, name, timed_method)
+
+    def end_frame(self):
+        phases = set(self.history) | set(self._current_frame)
+        for phase in phases:
+            self.history[phase].append(self._current_frame.get(phase, 0))
+        self._current_frame.clear()
+        self.num_frames += 1
+
+    def clear(self):
+        self.history.clear()
+        self._current_frame.clear()
+        self.num_frames = 0
+
+    def percentile(self, phase, percent):
+        return percentile(sorted(self.history.get(phase, ())), percent)
+
+    def report(self):
+        """
+        Return a dictionary mapping each phase to its mean, p50, p95, and p99
+        times (in seconds) over the recorded frames.
+        """
+        return {
+                phase: {
+                    'mean': sum(samples) / len(samples),
+                    'p50': self.percentile(phase, 50),
+                    'p95': self.percentile(phase, 95),
+                    'p99': self.percentile(phase, 99),
+                }
+                for phase, samples in self.history.items() if samples
+        }
+
+    def dump(self, file=None):
+        """
+        Print a table of the recorded percentiles, slowest phases first.
+        """
+        print("{} frames:".format(min(self.num_frames, self.history_length)), file=file)
+        print_report(self.report(), file)
+
+    def export(self, path):
+        """
+        Save the recorded percentiles to the given path as JSON.
+        """
+        with open(path, 'w') as file:
+            json.dump({
+                'num_frames': self.num_frames,
+                'phases': self.report(),
+            }, file, indent=2)
+
+
+def print_report(report, file=None):
+    """
+    Print a table of the percentiles returned by PhaseTimer.report(), slowest
+    phases first.
+    """
+    report_ms = {
+            phase: {key: 1e3 * value for key, value in stats.items()}
+            for phase, stats in report.items()
+    }
+    columns = [
+            ('mean (ms)', 'mean', '{:.3f}'),
+            ('p50', 'p50', '{:.3f}'),
+            ('p95', 'p95', '{:.3f}'),
+            ('p99', 'p99', '{:.3f}'),
+    ]
+    print_table(report_ms, 'phase', columns,
+            sort_key=lambda stats: -stats['mean'], file=file)
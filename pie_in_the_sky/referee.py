@@ -1,18 +1,79 @@
 #!/usr/bin/env python3
 
-import kxg
+import kxg, collections
+import numpy as np
 from . import messages, tokens
 
 class Referee (kxg.Referee):
 
+    # The referee periodically sends the state of the field objects to the 
+    # clients, to correct any drift between their worlds and its own (every 
+    # `sync_interval` seconds, unless `adaptive_sync` is enabled; see below).  
+    # In 'full' mode, every object is sent with every sync.  In 'delta' mode, 
+    # the referee keeps its own prediction of where the clients think each 
+    # object is, by integrating the last state it sent for each object under 
+    # the same gravity the clients simulate (see SyncPredictions), and only 
+    # resends the objects whose position has strayed more than 
+    # `sync_position_threshold` pixels from that prediction (or whose 
+    # velocity has strayed by more than `sync_velocity_threshold` 
+    # pixels/sec).  A full keyframe is still sent every `keyframe_interval` 
+    # seconds, so clients can recover from anything the predictions miss.  
+    # Keeping the predictions costs the referee one extra gravity calculation 
+    # per frame.
+
+    sync_mode = 'full'
+    sync_interval = 1
+    sync_position_threshold = 2
+    sync_velocity_threshold = 10
+    keyframe_interval = 5
+
+    # How the positions and velocities in sync messages are encoded: either 
+    # 'float32' or 'int16' (quantized, half the size).  See the packing module.
+
+    sync_encoding = 'float32'
+
+    # If `adaptive_sync` is enabled, syncs aren't sent on a fixed timer.  
+    # Instead, the referee estimates how far the clients have probably drifted 
+    # since the last sync, and sends a sync once that estimate reaches 
+    # `sync_drift_threshold` pixels, but never more often than every 
+    # `min_sync_interval` seconds or less often than every `max_sync_interval` 
+    # seconds.  Clients mostly drift because they resolve collisions a little 
+    # differently than the referee, so each collision adds `collision_drift` 
+    # pixels to the estimate.  Small errors in velocity also add up over time, 
+    # so the estimate grows by `speed_drift` times the distance the fastest 
+    # object could have covered since the last sync.
+
+    adaptive_sync = False
+    min_sync_interval = 0.25
+    max_sync_interval = 2
+    sync_drift_threshold = 5
+    collision_drift = 2
+    speed_drift = 0.01
+
+    # If the world is in thin client mode (see World.thin_client), the 
+    # clients don't simulate anything and just interpolate between the states 
+    # the referee sends them, so there's no drift to correct.  Instead, a full 
+    # sync is sent every `snapshot_interval` seconds, regardless of the 
+    # settings above.
+
+    snapshot_interval = 1 / 20
+
     def __init__(self):
         super().__init__()
         self.num_players_expected = None
         self.last_sync = 0
+        self.last_keyframe = 0
+        self.sync_predictions = SyncPredictions()
+        self.collisions_since_sync = 0
+        self.drift_estimate = 0
+        self.sync_intervals = collections.deque(maxlen=20)
+        self.collisions = CollisionBuffer()
 
     def on_start_game(self, num_players):
         self.num_players_expected = num_players
+        self.add_collision_handlers()
 
+    def add_collision_handlers(self):
         self.world.space.add_collision_handler(
                 tokens.Bullet.collision_type,
                 tokens.Bullet.collision_type,
@@ -35,31 +96,324 @@ class Referee (kxg.Referee):
         kxg.info("{num_players_joined} of {self.num_players_expected} players created.")
 
         if num_players_joined == self.num_players_expected:
-            self >> messages.StartGame(self.world)
+            self >> self.make_start_message()
+
+    def make_start_message(self):
+        return messages.StartGame(self.world)
 
     def on_update_game(self, dt):
+        self.dispatch_collisions()
+
+        if self.sync_mode == 'delta' and not self.world.thin_client:
+            self.sync_predictions.advance(self.world, dt)
+
         self.last_sync += dt
-        if self.last_sync > 1:
-            self >> messages.SyncWorlds(self.world)
+        self.last_keyframe += dt
+
+        if self.is_sync_due():
+            self.sync_worlds()
+            self.sync_intervals.append(self.last_sync)
             self.last_sync = 0
+            self.collisions_since_sync = 0
+            self.drift_estimate = 0
+
+    def is_sync_due(self):
+        if self.world.thin_client:
+            return self.last_sync >= self.snapshot_interval
+        if not self.adaptive_sync:
+            return self.last_sync > self.sync_interval
+        if self.last_sync < self.min_sync_interval:
+            return False
+        if self.last_sync >= self.max_sync_interval:
+            return True
+
+        self.drift_estimate = self.estimate_drift()
+        return self.drift_estimate >= self.sync_drift_threshold
+
+    def estimate_drift(self):
+        """
+        Return a rough estimate (in pixels) of how far the clients' worlds 
+        have drifted from the referee's since the last sync.
+        """
+        velocities = self.world.field_state.velocities
+        max_speed = 0
+        if len(velocities):
+            max_speed = np.sqrt(np.einsum('ij,ij->i', velocities, velocities).max())
+
+        return self.collision_drift * self.collisions_since_sync + \
+               self.speed_drift * max_speed * self.last_sync
+
+    @property
+    def sync_rate(self):
+        """
+        The number of syncs sent per second, averaged over the most recent 
+        syncs.
+        """
+        total_time = sum(self.sync_intervals)
+        return len(self.sync_intervals) / total_time if total_time else 0
+
+    def sync_metrics(self):
+        return {
+                'sync_rate': self.sync_rate,
+                'last_sync_interval':
+                    self.sync_intervals[-1] if self.sync_intervals else None,
+                'drift_estimate': self.drift_estimate,
+                'collisions_since_sync': self.collisions_since_sync,
+        }
+
+    def sync_worlds(self):
+        if self.sync_mode == 'full' or self.world.thin_client or \
+                self.last_keyframe > self.keyframe_interval:
+            self >> messages.SyncWorlds(self.world, self.sync_encoding)
+            self.last_keyframe = 0
+            self.sync_predictions.clear()
+            self.record_sync_baselines(self.world.field_objects)
+
+        elif self.sync_mode == 'delta':
+            drifted = self.find_drifted_tokens()
+            if drifted:
+                self >> messages.SyncDelta(
+                        self.world, drifted, self.sync_encoding)
+                self.record_sync_baselines(drifted)
+
+        else:
+            raise ValueError("unknown sync mode: {}".format(self.sync_mode))
+
+    def find_drifted_tokens(self):
+        """
+        Return a list of the field objects that have strayed too far from 
+        where the clients should think they are.  Objects that have never 
+        been synced are always included.
+        """
+        world = self.world
+        if world.field_state.is_stale(world.field_objects):
+            world.update_field_state()
+
+        state = world.field_state
+        predictions = self.sync_predictions
+        predictions.forget_removed(state.rows)
+
+        if not state.objects:
+            return []
+
+        # Objects that have never been synced get a row of NaNs, which never 
+        # counts as being in sync.
+
+        rows = np.array([
+                predictions.rows.get(token, -1) for token in state.objects])
+        synced = rows >= 0
+
+        predicted_positions = np.full((len(rows), 2), np.nan)
+        predicted_velocities = np.full((len(rows), 2), np.nan)
+        predicted_positions[synced] = predictions.positions[rows[synced]]
+        predicted_velocities[synced] = predictions.velocities[rows[synced]]
+
+        position_error = np.hypot(*(state.positions - predicted_positions).T)
+        velocity_error = np.hypot(*(state.velocities - predicted_velocities).T)
+
+        in_sync = (position_error <= self.sync_position_threshold) & \
+                  (velocity_error <= self.sync_velocity_threshold)
+
+        return [
+                token
+                for token, ok in zip(state.objects, in_sync)
+                if not ok
+        ]
+
+    def record_sync_baselines(self, tokens):
+        self.sync_predictions.record(tokens, self.world.field_state)
+
+    def dispatch_collisions(self):
+        """
+        Send the collisions since the last frame as a batch of hits.
+        """
+        for hits in self.collisions.flush(self.world):
+            self >> messages.HitBatch(hits)
+            self.collisions_since_sync += len(hits)
+
+            for hit in hits:
+                if isinstance(hit, messages.HitTarget) and \
+                        hit.target and hit.target.is_final_target:
+                    self >> messages.EndGame(hit.shooter)
+                    return
+
+    # The physics engine calls these handlers after every step in which two 
+    # objects are touching, and it takes several steps per frame, so the same 
+    # collision is usually reported many times before the messages that would 
+    # remove the objects involved could be executed.  So the collisions are 
+    # just recorded here, and dispatch_collisions() sends the messages at the 
+    # start of the next frame.
 
     def on_hit_bullet(self, space, arbiter):
         bullet = arbiter.shapes[0].token
         other_bullet = arbiter.shapes[1].token
-        self >> messages.HitBullet(bullet, other_bullet)
+        self.collisions.add(messages.HitBullet, bullet, other_bullet)
 
     def on_hit_target(self, space, arbiter):
         bullet = arbiter.shapes[0].token
         target = arbiter.shapes[1].token
-        self >> messages.HitTarget(bullet, target)
-        if not bullet.player.targets and target.is_final_target:
-            self >> messages.EndGame(bullet.player)
+        self.collisions.add(messages.HitTarget, bullet, target)
 
     def on_hit_obstacle(self, space, arbiter):
         bullet = arbiter.shapes[0].token
         obstacle = arbiter.shapes[1].token
-        self >> messages.HitObstacle(bullet, obstacle)
+        self.collisions.add(messages.HitObstacle, bullet, obstacle)
+
+
+class SyncPredictions:
+    """
+    Predict where the clients think each field object is, given the states 
+    the referee has sent them.
+
+    Between syncs, the clients simulate the field themselves, so the 
+    predictions are advanced every frame the same way: gravity is calculated 
+    with the world's solver and held constant over the frame, and objects 
+    bounce elastically off the walls.  Collisions between objects aren't 
+    modeled, so objects that hit each other stray from their predictions and 
+    get resent, which is what should happen anyway.
+    """
+
+    def __init__(self):
+        self.clear()
+
+    def __contains__(self, token):
+        return token in self.rows
+
+    def clear(self):
+        self.tokens = []
+        self.rows = {}
+        self.positions = np.zeros((0, 2))
+        self.velocities = np.zeros((0, 2))
+        self.masses = np.zeros(0)
+        self.radii = np.zeros(0)
+
+    def record(self, tokens, state):
+        """
+        Remember the current state of the given tokens, which was just sent 
+        to the clients.
+        """
+        new_tokens = []
+
+        for token in tokens:
+            row = state.rows.get(token)
+            if row is None:
+                continue
+            if token in self.rows:
+                self.positions[self.rows[token]] = state.positions[row]
+                self.velocities[self.rows[token]] = state.velocities[row]
+            else:
+                new_tokens.append((token, row))
+
+        if new_tokens:
+            rows = [row for token, row in new_tokens]
+            for token, row in new_tokens:
+                self.rows[token] = len(self.tokens)
+                self.tokens.append(token)
+
+            self.positions = np.vstack((self.positions, state.positions[rows]))
+            self.velocities = np.vstack((self.velocities, state.velocities[rows]))
+            self.masses = np.concatenate((self.masses, state.masses[rows]))
+            self.radii = np.concatenate((self.radii, state.radii[rows]))
+
+    def forget_removed(self, present):
+        """
+        Forget any tokens that aren't in the given collection.
+        """
+        keep = [i for i, token in enumerate(self.tokens) if token in present]
+        if len(keep) == len(self.tokens):
+            return
+
+        self.tokens = [self.tokens[i] for i in keep]
+        self.rows = {token: i for i, token in enumerate(self.tokens)}
+        self.positions = self.positions[keep]
+        self.velocities = self.velocities[keep]
+        self.masses = self.masses[keep]
+        self.radii = self.radii[keep]
+
+    def advance(self, world, dt):
+        if not self.tokens:
+            return
+
+        forces = world.calculate_gravity(
+                self.tokens, self.positions, self.masses)
+        accelerations = forces / self.masses[:,np.newaxis]
+
+        # The clients' physics engine takes `k` semi-implicit Euler steps of 
+        # size `h` over the frame, which works out to the following.
+
+        h = world.physics_step_size
+        k = max(int(round(dt / h)), 1)
+
+        self.positions += k * h * self.velocities + \
+                (k * (k + 1) / 2) * h**2 * accelerations
+        self.velocities += k * h * accelerations
+
+        # Bounce off the walls, which the objects touch when their centers 
+        # are one radius away.
+
+        low = np.array([world.field.left, world.field.bottom]) + self.radii[:,np.newaxis]
+        high = np.array([world.field.right, world.field.top]) - self.radii[:,np.newaxis]
+
+        below, above = self.positions < low, self.positions > high
+        self.positions = np.where(below, 2 * low - self.positions, self.positions)
+        self.positions = np.where(above, 2 * high - self.positions, self.positions)
+        self.velocities[below | above] *= -1
+
+
+class CollisionBuffer:
+    """
+    Collect the collisions reported by the physics engine over the course of a 
+    frame, so that they can be sent as a single batch of hits.
+
+    Collisions are recorded once per pair of objects, in the order they first 
+    happened.  When the buffer is flushed, a collision is dropped if either of 
+    its objects has already been removed from the world, or will be removed 
+    by a collision that happened before it (e.g. a bullet that hit two targets 
+    in the same frame only counts against the first one).
+    """
+
+    def __init__(self):
+        self.events = {}
+
+    def __len__(self):
+        return len(self.events)
+
+    def add(self, message_cls, bullet, other):
+        key = frozenset((bullet, other))
+        if key not in self.events:
+            self.events[key] = message_cls, bullet, other
+
+    def flush(self, world):
+        """
+        Empty the buffer and yield lists of hits for the collisions that are 
+        still relevant.  There's normally just one list, but a new one is 
+        started whenever a hit depends on the outcome of an earlier hit: 
+        whether the final target counts depends on whether the shooter has any 
+        targets left, so a bullet hitting a target after the shooter's other 
+        targets were hit has to wait for those hits to be executed.  So each 
+        list should be sent before the next one is yielded.
+        """
+        events, self.events = self.events, {}
+        consumed = set()
+        hits = []
+
+        for message_cls, bullet, other in events.values():
+            if bullet in consumed or other in consumed:
+                continue
+            if bullet not in world or other not in world:
+                continue
+
+            if message_cls is messages.HitTarget and hits and \
+                    consumed.intersection(bullet.player.targets):
+                yield hits
+                hits = []
+
+            hit = message_cls(bullet, other)
+            consumed.update(hit.tokens_to_remove())
+            hits.append(hit)
 
+        if hits:
+            yield hits
 
 def on_hit_bullet(space, arbiter, reporter):
     bullet = arbiter.shapes[0].token
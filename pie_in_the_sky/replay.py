@@ -0,0 +1,457 @@
+#!/usr/bin/env python3
+
+"""
+Record matches and play them back, with fast seeking.
+
+A recording is everything needed to reproduce a match: every message that was
+executed (serialized exactly as it would be sent over the network) and the
+time step of every frame.  The world's physics settings (see WORLD_SETTINGS)
+are recorded when the recorder is attached, since the same messages can play
+out differently with a different solver or time step.  Every
+`keyframe_interval` seconds of game time, the state of the world (see
+World.snapshot) is recorded as well.
+
+The file is written strictly by appending.  Records are collected into
+blocks, each of which is compressed on its own and starts with a keyframe, so
+any block can be decompressed without the ones before it.  When the recording
+is closed, an index of the keyframes is appended, followed by a footer giving
+the position of the index.  (If a recording is never closed, e.g. because the
+game crashed, the index is rebuilt by scanning the blocks.)
+
+To seek to a given time, the player finds the last keyframe before it, then:
+
+1. Executes every message before that keyframe without simulating any
+   physics, which recreates all the tokens (bullets, targets, players, etc.)
+   that were in the world at the time.  Sync messages are skipped, since they
+   only move things around.  This is cheap compared to simulating the game.
+
+2. Restores the state from the keyframe.
+
+3. Fast-forwards headlessly, executing messages and simulating frames, until
+   the requested time is reached.
+
+Playback isn't bit-for-bit identical to the original match.  The physics
+engine caches some information about contacts between steps, which isn't part
+of a keyframe, and the order in which it resolves contacts can change from one
+process to the next.  The differences start out at the level of rounding
+error, but the field objects pull on each other, so they grow over time: after
+a few seconds they're still a tiny fraction of a pixel, but after a few tens
+of seconds objects can be in visibly different places.  To keep them from
+growing, the player restores each keyframe it plays through.
+
+Usage:
+    python -m pie_in_the_sky.replay FILE [--seek SECONDS]
+"""
+
+import kxg, zlib, struct, pickle, collections
+import numpy as np
+from kxg.multiplayer import MessageSerializer
+from . import messages
+from .instrumentation import Hooks
+from .world import World, WorldSnapshot
+
+FILE_MAGIC = b'PIEREPLAY2\n'
+SETTINGS_MAGIC = b'PIES'
+BLOCK_MAGIC = b'PIEB'
+INDEX_MAGIC = b'PIEI'
+FOOTER_MAGIC = b'PIEINDEX'
+
+BLOCK_HEADER = struct.Struct('<4sI')
+RECORD_HEADER = struct.Struct('<BI')
+FOOTER = struct.Struct('<8sQ')
+FRAME = struct.Struct('<d')
+
+KEYFRAME, FRAME_RECORD, MESSAGE = range(3)
+
+Keyframe = collections.namedtuple('Keyframe', 'time, frame, offset')
+
+# The world settings that affect how a match plays out.  These are recorded
+# from the world being recorded (which may have overridden the class defaults)
+# and applied to the world that plays the recording back.
+
+WORLD_SETTINGS = (
+        'field_size',
+        'gravity_constant',
+        'elasticity_constant',
+        'gravity_solver',
+        'barnes_hut_theta',
+        'physics_dt',
+        'max_physics_steps',
+        'adaptive_physics',
+        'min_physics_dt',
+        'max_physics_dt',
+        'max_physics_travel',
+)
+
+class ReplayRecorder:
+    """
+    Record the messages and frames of a match to the given file.
+
+    Like the PhaseTimer and the MessageLog, the recorder works by hooking
+    methods when it's attached.  Attach it before the game starts to record
+    the whole match, and close it once the match is over.
+    """
+
+    def __init__(self, path, keyframe_interval=5):
+        self.path = path
+        self.keyframe_interval = keyframe_interval
+        self.file = open(path, 'wb')
+        self.file.write(FILE_MAGIC)
+        self.keyframes = []
+        self.block = bytearray()
+        self.time = 0
+        self.num_frames = 0
+        self.time_since_keyframe = 0
+        self.world = None
+        self._serializer = None
+        self._hooks = Hooks()
+
+    def attach(self, world, actors):
+        """
+        Start recording the given world.  At least one actor running on this
+        machine must be given, because messages are recorded as they're
+        relayed to the actors (i.e. just before they're executed).
+        """
+        self.world = world
+        self._serializer = MessageSerializer(world)
+
+        write_block(self.file, SETTINGS_MAGIC, pickle.dumps({
+            name: getattr(world, name) for name in WORLD_SETTINGS
+        }, pickle.HIGHEST_PROTOCOL))
+
+        def relay_message(original, message):
+            self.add_record(MESSAGE, self._serializer.pack(message))
+            return original(message)
+
+        # Frames are recorded once they've been simulated, after any messages 
+        # sent during the update (e.g. the AIs shoot from their cannons' 
+        # on_update_game() callbacks).  Those messages were executed before 
+        # the physics was stepped, so that's when the player executes them.
+
+        def on_update_game(original, dt):
+            result = original(dt)
+            self.add_record(FRAME_RECORD, FRAME.pack(dt))
+
+            self.time += dt
+            self.num_frames += 1
+            self.time_since_keyframe += dt
+
+            if self.time_since_keyframe >= self.keyframe_interval:
+                self.add_keyframe()
+
+            return result
+
+        self.add_keyframe()
+        self._hooks.add(actors[0], '_relay_message', relay_message)
+        self._hooks.add(world, 'on_update_game', on_update_game)
+
+    def detach(self):
+        self._hooks.remove_all()
+
+    def add_record(self, kind, payload):
+        self.block += RECORD_HEADER.pack(kind, len(payload))
+        self.block += payload
+
+    def add_keyframe(self):
+        self.flush_block()
+        self.keyframes.append(
+                Keyframe(self.time, self.num_frames, self.file.tell()))
+        self.add_record(KEYFRAME, pack_snapshot(self.world.snapshot()))
+        self.time_since_keyframe = 0
+
+    def flush_block(self):
+        if self.block:
+            write_block(self.file, BLOCK_MAGIC, self.block)
+            self.block = bytearray()
+
+    def close(self):
+        """
+        Stop recording, then write out the last block and the index.
+        """
+        self.detach()
+        self.flush_block()
+
+        index_offset = self.file.tell()
+        write_block(self.file, INDEX_MAGIC, pickle.dumps({
+            'keyframes': [tuple(x) for x in self.keyframes],
+            'duration': self.time,
+        }, pickle.HIGHEST_PROTOCOL))
+        self.file.write(FOOTER.pack(FOOTER_MAGIC, index_offset))
+        self.file.close()
+
+
+class ReplayPlayer:
+    """
+    Play back a recorded match, starting from any point in it.
+
+    Call `seek()` to get a world in the state it was in at the given time,
+    then `advance()` to play forward from there.  The world is driven the
+    same way the headless runner drives it, so nothing is drawn.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.settings = read_settings(path)
+        self.keyframes, self.duration = read_index(path)
+        self.world = None
+        self.forum = None
+        self.time = 0
+        self._records = iter(())
+        self._serializer = None
+
+    def seek(self, time):
+        """
+        Put the world in the state it was in at the first frame boundary at or
+        after the given time, and return it.
+        """
+        keyframe = self.keyframes[0]
+        for candidate in self.keyframes:
+            if candidate.time <= time:
+                keyframe = candidate
+
+        self.reset()
+
+        # Recreate all the tokens that existed at the time of the keyframe.
+
+        for offset, kind, payload in read_records(
+                self.path, self.keyframes[0].offset, stop=keyframe.offset):
+            if kind == MESSAGE:
+                message = self._serializer.unpack(payload)
+                if not isinstance(message, messages.SyncWorlds):
+                    self.forum.execute_message(message)
+
+        # Restore the keyframe, then simulate the rest of the way.
+
+        self._records = read_records(self.path, keyframe.offset)
+        offset, kind, payload = next(self._records)
+        assert kind == KEYFRAME
+
+        with self.world._unlock_temporarily():
+            self.world.restore(unpack_snapshot(self.world, payload))
+
+        self.time = keyframe.time
+        self.advance(time - self.time)
+        return self.world
+
+    def advance(self, duration):
+        """
+        Play forward by (at least) the given amount of game time, or until the
+        recording ends.  Return False if the recording has ended.
+        """
+        end_time = self.time + duration
+
+        while self.time < end_time and not self.world.has_game_ended():
+            try:
+                offset, kind, payload = next(self._records)
+            except StopIteration:
+                return False
+
+            # Sync messages didn't change the referee's world while the match 
+            # was being recorded, so they shouldn't change this one either.
+
+            if kind == MESSAGE:
+                message = self._serializer.unpack(payload)
+                if not isinstance(message, messages.SyncWorlds):
+                    self.forum.execute_message(message)
+
+            elif kind == KEYFRAME:
+                with self.world._unlock_temporarily():
+                    self.world.restore(unpack_snapshot(self.world, payload))
+
+            elif kind == FRAME_RECORD:
+                dt, = FRAME.unpack(payload)
+                with self.world._unlock_temporarily():
+                    self.world.on_update_game(dt)
+                self.time += dt
+
+        return not self.world.has_game_ended()
+
+    def reset(self):
+        self.world = World()
+        for name, value in self.settings.items():
+            setattr(self.world, name, value)
+
+        self.forum = kxg.Forum()
+        self._serializer = MessageSerializer(self.world)
+
+        with self.world._unlock_temporarily():
+            self.forum.connect_everyone(self.world, [])
+            self.world.on_start_game()
+
+
+def pack_snapshot(snapshot):
+    """
+    Convert a WorldSnapshot into bytes, referring to tokens by their ids.
+    """
+    return pickle.dumps({
+        'ids': np.array([x.id for x in snapshot.objects], dtype='<u4').tobytes(),
+        'bodies': snapshot.bodies.astype('<f8').tobytes(),
+        'players': [
+            (player.id, arsenal, _arsenal, [x.id for x in targets])
+            for player, arsenal, _arsenal, targets in snapshot.players
+        ],
+        'physics_lag': snapshot.physics_lag,
+        'physics_step_size': snapshot.physics_step_size,
+        'dropped_physics_time': snapshot.dropped_physics_time,
+        'elapsed_time': snapshot.elapsed_time,
+        'winner': snapshot.winner.id if snapshot.winner else None,
+        'random_state': snapshot.random_state,
+    }, pickle.HIGHEST_PROTOCOL)
+
+def unpack_snapshot(world, data):
+    """
+    Convert bytes from pack_snapshot() back into a WorldSnapshot for the given
+    world, which must contain all the tokens that it refers to.
+    """
+    data = pickle.loads(data)
+    get_token = world.get_token
+    ids = np.frombuffer(data['ids'], dtype='<u4').tolist()
+
+    return WorldSnapshot(
+            version=None,
+            objects=tuple(get_token(id) for id in ids),
+            bodies=np.frombuffer(data['bodies'], dtype='<f8').reshape(-1, 6),
+            players=tuple(
+                (get_token(id), arsenal, _arsenal,
+                    tuple(get_token(x) for x in targets))
+                for id, arsenal, _arsenal, targets in data['players']
+            ),
+            physics_lag=data['physics_lag'],
+            physics_step_size=data['physics_step_size'],
+            dropped_physics_time=data['dropped_physics_time'],
+            elapsed_time=data['elapsed_time'],
+            winner=get_token(data['winner']) if data['winner'] is not None else None,
+            random_state=data['random_state'],
+    )
+
+def write_block(file, magic, payload):
+    compressed = zlib.compress(bytes(payload))
+    file.write(BLOCK_HEADER.pack(magic, len(compressed)))
+    file.write(compressed)
+
+def read_blocks(file):
+    """
+    Yield the offset, magic, and compressed payload of each block, starting
+    from the current position in the given file.
+    """
+    while True:
+        offset = file.tell()
+        header = file.read(BLOCK_HEADER.size)
+        if len(header) < BLOCK_HEADER.size:
+            return
+
+        magic, size = BLOCK_HEADER.unpack(header)
+        if magic not in (SETTINGS_MAGIC, BLOCK_MAGIC, INDEX_MAGIC):
+            return
+
+        payload = file.read(size)
+        if len(payload) < size:
+            return
+
+        yield offset, magic, payload
+
+def read_records(path, offset, stop=None):
+    """
+    Yield the offset of the block, the kind, and the payload of each record, 
+    starting from the block at the given offset and stopping before the block 
+    at `stop` (or the index).
+    """
+    with open(path, 'rb') as file:
+        file.seek(offset)
+        for offset, magic, payload in read_blocks(file):
+            if magic == SETTINGS_MAGIC:
+                continue
+            if magic != BLOCK_MAGIC or offset == stop:
+                return
+
+            block = memoryview(zlib.decompress(payload))
+            position = 0
+            while position < len(block):
+                kind, size = RECORD_HEADER.unpack_from(block, position)
+                position += RECORD_HEADER.size
+                yield offset, kind, block[position:position + size]
+                position += size
+
+def read_settings(path):
+    """
+    Return the world settings recorded at the start of the given recording.
+    """
+    with open(path, 'rb') as file:
+        if file.read(len(FILE_MAGIC)) != FILE_MAGIC:
+            raise ValueError("{} isn't a replay file".format(path))
+
+        for offset, magic, payload in read_blocks(file):
+            if magic == SETTINGS_MAGIC:
+                return pickle.loads(zlib.decompress(payload))
+            break
+
+    raise ValueError("{} doesn't record the world's settings".format(path))
+
+def read_index(path):
+    """
+    Return the list of keyframes in the given recording and its duration, 
+    either from the index at the end of the file or, if the recording was 
+    never closed, by scanning through it.
+    """
+    with open(path, 'rb') as file:
+        if file.read(len(FILE_MAGIC)) != FILE_MAGIC:
+            raise ValueError("{} isn't a replay file".format(path))
+
+        file.seek(0, 2)
+        if file.tell() >= len(FILE_MAGIC) + FOOTER.size:
+            file.seek(-FOOTER.size, 2)
+            magic, index_offset = FOOTER.unpack(file.read(FOOTER.size))
+            if magic == FOOTER_MAGIC:
+                file.seek(index_offset)
+                for offset, magic, payload in read_blocks(file):
+                    index = pickle.loads(zlib.decompress(payload))
+                    keyframes = [Keyframe(*x) for x in index['keyframes']]
+                    return keyframes, index['duration']
+
+    return scan_index(path)
+
+def scan_index(path):
+    keyframes = []
+    time = num_frames = 0
+
+    for offset, kind, payload in read_records(path, len(FILE_MAGIC)):
+        if kind == KEYFRAME:
+            keyframes.append(Keyframe(time, num_frames, offset))
+        elif kind == FRAME_RECORD:
+            time += FRAME.unpack(payload)[0]
+            num_frames += 1
+
+    return keyframes, time
+
+def main():
+    import argparse, time
+
+    parser = argparse.ArgumentParser(
+            description="Play back a recorded match.")
+    parser.add_argument('path', metavar='FILE')
+    parser.add_argument('--seek', type=float, default=None,
+            help="print the state of the match at this many seconds in")
+    args = parser.parse_args()
+
+    player = ReplayPlayer(args.path)
+    print("{}: {} keyframes, {:.1f}s".format(
+        args.path, len(player.keyframes), player.duration))
+
+    if args.seek is not None:
+        start = time.perf_counter()
+        world = player.seek(args.seek)
+        elapsed = time.perf_counter() - start
+
+        print("seeked to {:.2f}s in {:.3f}s".format(player.time, elapsed))
+        print("{} bullets, {} targets, {} obstacles".format(
+            len(world.bullets), len(world.targets), len(world.obstacles)))
+        for player_token in world.players:
+            print("{}: arsenal={}, targets={}".format(
+                player_token.name, player_token.arsenal,
+                len(player_token.targets)))
+        if world.winner:
+            print("winner: {}".format(world.winner.name))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,173 @@
+#!/usr/bin/env python3
+
+"""
+Measure how frame time and memory scale with the number of field objects.
+
+For each combination of gravity solver and physics configuration, a series of
+increasingly crowded scenarios is generated and played headlessly for a fixed
+number of frames.  The mean frame time and the peak size of the python heap
+are recorded for each size, and written out as CSV.  If matplotlib is
+installed, the results can also be plotted.
+
+Note that the heap is measured with tracemalloc, which only sees memory
+allocated by python.  The memory chipmunk allocates in C for its bodies and
+shapes isn't included, so the true cost per object is somewhat higher.
+
+Usage:
+    python -m pie_in_the_sky.scaling [--bullets N ...] [--solvers NAME ...]
+                                     [--csv FILE] [--plot FILE]
+"""
+
+import time, tracemalloc, itertools, collections
+from . import headless, scenarios
+
+PHYSICS_CONFIGS = {
+        'fixed': {'adaptive_physics': False},
+        'adaptive': {'adaptive_physics': True},
+}
+
+Measurement = collections.namedtuple('Measurement', [
+    'solver', 'physics', 'num_objects', 'frame_time', 'python_heap',
+])
+
+def prepare_match(scenario, solver, physics, seed=0):
+    referee = scenarios.ScenarioReferee(scenario)
+    match = headless.setup_match(
+            scenario.num_players, seed=seed, referee=referee)
+
+    # Configure the world before the first update starts the game.
+
+    match.world.gravity_solver = solver
+    for key, value in PHYSICS_CONFIGS[physics].items():
+        setattr(match.world, key, value)
+
+    return match
+
+def measure(scenario, solver, physics, num_frames=50, dt=1/50, seed=0):
+    """
+    Play the given scenario for the given number of frames and return a
+    Measurement.  The frame time is measured on one run, and the peak size 
+    of the python heap over the same number of frames is measured (with 
+    tracemalloc, which slows things down) on a second run.
+    """
+    match = prepare_match(scenario, solver, physics, seed)
+    match.theater.update(dt)
+    num_objects = len(match.world.field_objects)
+
+    start = time.perf_counter()
+    num_timed_frames = play_frames(match, num_frames, dt)
+    frame_time = (time.perf_counter() - start) / max(num_timed_frames, 1)
+
+    tracemalloc.start()
+    try:
+        match = prepare_match(scenario, solver, physics, seed)
+        match.theater.update(dt)
+        play_frames(match, num_frames, dt)
+        python_heap = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+    return Measurement(solver, physics, num_objects, frame_time, python_heap)
+
+def play_frames(match, num_frames, dt):
+    num_played = 0
+    while num_played < num_frames and not match.theater.is_finished:
+        match.theater.update(dt)
+        num_played += 1
+    return num_played
+
+def sweep(bullet_counts, solvers, physics_configs, num_players=2,
+        targets_per_player=2, num_obstacles=2, num_frames=50):
+    """
+    Yield a Measurement for every combination of the given bullet counts,
+    gravity solvers, and physics configurations.
+    """
+    for solver, physics, num_bullets in itertools.product(
+            solvers, physics_configs, bullet_counts):
+        scenario = scenarios.Scenario(
+                num_players=num_players,
+                targets_per_player=targets_per_player,
+                num_obstacles=num_obstacles,
+                num_bullets=num_bullets,
+        )
+        yield measure(scenario, solver, physics, num_frames)
+
+def write_csv(measurements, file):
+    import csv
+    writer = csv.writer(file)
+    writer.writerow(Measurement._fields)
+    writer.writerows(measurements)
+
+def plot(measurements, path):
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+
+    fig, (time_axes, memory_axes) = plt.subplots(1, 2, figsize=(12, 5))
+    key = lambda x: (x.solver, x.physics)
+
+    for (solver, physics), group in itertools.groupby(
+            sorted(measurements, key=key), key=key):
+        group = sorted(group, key=lambda x: x.num_objects)
+        label = '{} / {}'.format(solver, physics)
+        n = [x.num_objects for x in group]
+        time_axes.plot(n, [1e3 * x.frame_time for x in group], 'o-', label=label)
+        memory_axes.plot(n, [x.python_heap / 1e6 for x in group], 'o-', label=label)
+
+    time_axes.set_xlabel('field objects')
+    time_axes.set_ylabel('frame time (ms)')
+    memory_axes.set_xlabel('field objects')
+    memory_axes.set_ylabel('peak python heap (MB)')
+    time_axes.legend()
+    fig.tight_layout()
+    fig.savefig(path)
+
+def main():
+    import argparse, sys
+
+    parser = argparse.ArgumentParser(
+            description="Measure how the engine scales with object count.")
+    parser.add_argument('--bullets', type=int, nargs='+',
+            default=[0, 25, 50, 100, 200, 400])
+    parser.add_argument('--solvers', nargs='+',
+            default=['vectorized', 'barnes_hut', 'test_particle'])
+    parser.add_argument('--physics', nargs='+',
+            default=sorted(PHYSICS_CONFIGS), choices=sorted(PHYSICS_CONFIGS))
+    parser.add_argument('--players', type=int, default=2)
+    parser.add_argument('--targets', type=int, default=2,
+            help="number of targets per player")
+    parser.add_argument('--obstacles', type=int, default=2)
+    parser.add_argument('--frames', type=int, default=50,
+            help="number of frames to time for each size")
+    parser.add_argument('--csv', metavar='FILE',
+            help="write the results to the given file instead of stdout")
+    parser.add_argument('--plot', metavar='FILE',
+            help="plot the results to the given image file (needs matplotlib)")
+    args = parser.parse_args()
+
+    measurements = []
+    for measurement in sweep(
+            args.bullets, args.solvers, args.physics,
+            args.players, args.targets, args.obstacles, args.frames):
+        measurements.append(measurement)
+        print("{0.solver:>14s}  {0.physics:>8s}  N={0.num_objects:<5d}  "
+              "{1:8.2f} ms  {2:8.2f} MB heap".format(
+                  measurement, 1e3 * measurement.frame_time,
+                  measurement.python_heap / 1e6),
+              file=sys.stderr)
+
+    if args.csv:
+        with open(args.csv, 'w', newline='') as file:
+            write_csv(measurements, file)
+    else:
+        write_csv(measurements, sys.stdout)
+
+    if args.plot:
+        try:
+            plot(measurements, args.plot)
+        except ImportError:
+            print("matplotlib is needed to plot the results.", file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,138 @@
+#!/usr/bin/env python3
+
+"""
+Generate games with arbitrary numbers of field objects.
+
+The normal StartGame message always creates the same handful of targets and
+obstacles.  The CreateScenario message instead creates however many targets,
+obstacles, and bullets (already in flight) are asked for, placing them so that
+nothing overlaps.  This is mostly useful for measuring how the engine scales.
+"""
+
+import collections, math
+from vecrec import Vector
+from . import messages, tokens
+from .referee import Referee
+
+Scenario = collections.namedtuple('Scenario', [
+    'num_players',
+    'targets_per_player',
+    'num_obstacles',
+    'num_bullets',
+])
+
+class CreateScenario (messages.StartGame):
+    """
+    Create the targets, obstacles, cannons, and bullets for a scenario.
+    """
+
+    def __init__(self, world, scenario):
+        field = world.field
+        players = world.players
+
+        # Give every player a cannon along the left edge of the field, just
+        # like in a normal game.
+
+        self.cannons = [
+                tokens.Cannon(player, Vector(
+                    field.left, (i + 1) * field.height / (len(players) + 1)))
+                for i, player in enumerate(players)
+        ]
+
+        # Lay out every field object without any overlaps, leaving a margin
+        # along the left edge so nothing starts on top of a cannon.
+
+        num_targets = len(players) * scenario.targets_per_player + 1
+        radii = (
+                [tokens.Target.radius] * num_targets +
+                [tokens.Obstacle.radius] * scenario.num_obstacles +
+                [tokens.Bullet.radius] * scenario.num_bullets
+        )
+        positions = iter(place_circles(
+                world.random, field.get_shrunk(20), radii, left_margin=50))
+
+        self.targets = [
+                tokens.Target(
+                    next(positions), world.random_vector(50), player)
+                for player in players
+                for i in range(scenario.targets_per_player)
+        ]
+        self.final_target = tokens.Target(
+                next(positions), world.random_vector(50))
+        self.targets.append(self.final_target)
+
+        self.obstacles = [
+                tokens.Obstacle(next(positions), world.random_vector(10))
+                for i in range(scenario.num_obstacles)
+        ]
+        self.bullets = [
+                tokens.Bullet(
+                    world.random.choice(self.cannons),
+                    next(positions),
+                    world.random_vector(150))
+                for i in range(scenario.num_bullets)
+        ] if self.cannons else []
+
+    def tokens_to_add(self):
+        yield from super().tokens_to_add()
+        yield from self.bullets
+
+
+class ScenarioReferee (Referee):
+    """
+    A referee that starts the game with a scenario instead of the normal
+    StartGame message.
+    """
+
+    def __init__(self, scenario):
+        super().__init__()
+        self.scenario = scenario
+
+    def make_start_message(self):
+        return CreateScenario(self.world, self.scenario)
+
+
+def place_circles(rng, rect, radii, left_margin=0, max_attempts=1000):
+    """
+    Return a list of positions within the given rectangle at which circles of
+    the given radii can be placed without overlapping.
+
+    Positions are picked randomly and rejected if they overlap any circle
+    that's already been placed.  The largest circles are placed first, and a
+    grid is used to find nearby circles, so this is fast even for thousands of
+    circles.  A ValueError is raised if the circles don't seem to fit.
+    """
+    if not radii:
+        return []
+
+    cell_size = 2 * max(radii)
+    grid = collections.defaultdict(list)
+    positions = [None] * len(radii)
+
+    def cell_of(x, y):
+        return int(x // cell_size), int(y // cell_size)
+
+    def overlaps(x, y, r):
+        i, j = cell_of(x, y)
+        for di in (-1, 0, 1):
+            for dj in (-1, 0, 1):
+                for other_x, other_y, other_r in grid[i + di, j + dj]:
+                    if math.hypot(x - other_x, y - other_y) < r + other_r:
+                        return True
+        return False
+
+    for index in sorted(range(len(radii)), key=lambda i: -radii[i]):
+        r = radii[index]
+        for attempt in range(max_attempts):
+            x = rng.uniform(rect.left + left_margin + r, rect.right - r)
+            y = rng.uniform(rect.bottom + r, rect.top - r)
+            if not overlaps(x, y, r):
+                break
+        else:
+            raise ValueError("couldn't fit {} circles in {}".format(len(radii), rect))
+
+        grid[cell_of(x, y)].append((x, y, r))
+        positions[index] = Vector(x, y)
+
+    return positions
+
@@ -35,6 +35,10 @@ class Player(kxg.Token):
         self.arsenal -= bullet.mass
         self._arsenal -= bullet.mass
 
+    def refund_arsenal(self, bullet):
+        self._arsenal = min(self._arsenal + bullet.mass, self.max_arsenal)
+        self.arsenal = int(self._arsenal)
+
     def recharge_arsenal(self, dt):
         if not self.arsenal == self.max_arsenal:
             self._arsenal += dt * self.arsenal_recharge_rate
@@ -52,11 +56,7 @@ class Cannon(kxg.Token):
         self.muzzle_speed = 150
 
     def __extend__(self):
-        from . import gui, ai
-        return {
-                gui.GuiActor: gui.CannonExtension,
-                ai.AiActor: ai.CannonExtension,
-        }
+        return loaded_extensions(gui='CannonExtension', ai='CannonExtension')
 
 
 class FieldObject(kxg.Token):
@@ -64,6 +64,8 @@ class FieldObject(kxg.Token):
     A base class for targets, bullets, obstacles, and other objects that are in the field of play. Instances of this base class can be used if special methods are not necessary for a type of object. This class defines default functionality for motion, collisions, and updating.
     """
 
+    owner = None
+
     def __init__(self, position, velocity, mass=1, radius=20):
         super().__init__()
 
@@ -74,10 +76,22 @@ class FieldObject(kxg.Token):
 
     @property
     def position(self):
+        # Prefer the copy of the position in the world's field state, so that 
+        # everything sees the same state for the whole frame.  Fall back on 
+        # the body for objects that were added after the field state was last 
+        # filled.
+        if self.world is not None:
+            position = self.world.field_state.position_of(self)
+            if position is not None:
+                return position
         return cast_anything_to_vector(self.body.position)
 
     @property
     def velocity(self):
+        if self.world is not None:
+            velocity = self.world.field_state.velocity_of(self)
+            if velocity is not None:
+                return velocity
         return cast_anything_to_vector(self.body.velocity)
 
     def on_add_to_world(self, world):
@@ -90,9 +104,12 @@ class FieldObject(kxg.Token):
         self.shape.elasticity = world.elasticity_constant
         self.shape.token = self
         world.space.add(self.body, self.shape)
+        world.field_objects.add(self)
 
     def on_remove_from_world(self):
         self.world.space.remove(self.body, self.shape)
+        self.world.field_objects.remove(self)
+        self.world.visual_offsets.pop(self, None)
 
     def on_hit_by_bullet(self, bullet):
         pass
@@ -101,57 +118,74 @@ class FieldObject(kxg.Token):
 class Bullet(FieldObject):
 
     collision_type = 1
+    radius = 5
 
     def __init__(self, cannon, position, velocity):
-        super().__init__(position, velocity, mass=1, radius=5)
+        super().__init__(position, velocity, mass=1, radius=self.radius)
         self.cannon = cannon
         
     def __extend__(self):
-        from . import gui
-        return {gui.GuiActor: gui.BulletExtension}
+        return loaded_extensions(gui='BulletExtension')
 
     @property
     def player(self):
         return self.cannon.player
 
-    def on_remove_from_world(self):
-        super().on_remove_from_world()
-        self.world.bullets.remove(self)
+    @property
+    def owner(self):
+        return self.cannon.player
 
 
 class Target(FieldObject):
 
     collision_type = 2
+    radius = 15
 
     def __init__(self, position, velocity, owner=None):
-        super().__init__(position, velocity, mass=2, radius=15)
+        super().__init__(position, velocity, mass=2, radius=self.radius)
         self.owner = owner
         
     def __extend__(self):
-        from . import gui
-        return {gui.GuiActor: gui.TargetExtension}
+        return loaded_extensions(gui='TargetExtension')
 
     @property
     def is_final_target(self):
         return self.owner is None
 
-    def on_remove_from_world(self):
-        super().on_remove_from_world()
-        self.world.targets.remove(self)
-
 
 class Obstacle(FieldObject):
 
     collision_type = 3
+    radius = 20
 
     def __init__(self, position, velocity):
-        super().__init__(position, velocity, mass=5, radius=20)
+        super().__init__(position, velocity, mass=5, radius=self.radius)
 
     def __extend__(self):
-        from . import gui
-        return {gui.GuiActor: gui.ObstacleExtension}
+        return loaded_extensions(gui='ObstacleExtension')
 
-    def on_remove_from_world(self):
-        super().on_remove_from_world()
-        self.world.obstacles.remove(self)
 
+
+def loaded_extensions(**extension_names):
+    """
+    Return a dictionary mapping actor classes to token extension classes, for 
+    use in Token.__extend__().
+
+    Each keyword argument names a module in this package and the extension 
+    class within it, e.g. `gui='BulletExtension'` maps gui.GuiActor to 
+    gui.BulletExtension.  Modules that haven't been imported are skipped, 
+    since there can't be any actors from them.  This keeps the tokens from 
+    importing the gui (and therefore pyglet and glooey) in headless games.
+    """
+    import sys
+
+    actor_names = {'gui': 'GuiActor', 'ai': 'AiActor'}
+    extensions = {}
+
+    for module_name, extension_name in extension_names.items():
+        module = sys.modules.get(__package__ + '.' + module_name)
+        if module is not None:
+            actor_cls = getattr(module, actor_names[module_name])
+            extensions[actor_cls] = getattr(module, extension_name)
+
+    return extensions
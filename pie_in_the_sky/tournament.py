@@ -0,0 +1,122 @@
+#!/usr/bin/env python3
+
+"""
+Play many headless AI-vs-AI matches in parallel.
+
+Each match is played in its own process, with its own World, Referee, and
+AiActors, so a sweep scales with the number of cores.  Every match is given a
+seed (so any match can be replayed exactly with the headless runner), and
+results are streamed back as soon as each match finishes.
+
+Usage:
+    python -m pie_in_the_sky.tournament [--ais N] [--matches N] [--workers N]
+"""
+
+import collections
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from . import headless
+
+def play_seeded_match(seed, num_ais=2, dt=1/50, max_simulated_time=600):
+    """
+    Play a single headless match with the given seed.  This is the function 
+    that runs in each worker process.
+    """
+    result = headless.play_match(num_ais, dt, max_simulated_time, seed=seed)
+    return seed, result
+
+def run_tournament(seeds, num_ais=2, dt=1/50, max_simulated_time=600, num_workers=None):
+    """
+    Play one match for each of the given seeds, spread across a pool of
+    `num_workers` processes (one per core by default).  Yield (seed, result)
+    pairs in the order that the matches finish.
+    """
+    with ProcessPoolExecutor(num_workers) as executor:
+        futures = [
+                executor.submit(play_seeded_match,
+                    seed, num_ais, dt, max_simulated_time)
+                for seed in seeds
+        ]
+        for future in as_completed(futures):
+            yield future.result()
+
+
+class Standings:
+    """
+    Keep a running tally of the results of a tournament.
+    """
+
+    def __init__(self, num_ais):
+        self.num_ais = num_ais
+        self.num_matches = 0
+        self.num_frames = 0
+        self.wall_time = 0
+        self.wins = collections.Counter()
+
+    def add_result(self, result):
+        self.num_matches += 1
+        self.num_frames += result.num_frames
+        self.wall_time += result.wall_time
+        self.wins[result.winner] += 1
+
+    @property
+    def num_draws(self):
+        return self.wins[None]
+
+    @property
+    def win_rates(self):
+        """
+        Return a list giving the fraction of matches won by each AI.
+        """
+        return [
+                self.wins[i] / self.num_matches if self.num_matches else 0
+                for i in range(self.num_ais)
+        ]
+
+    @property
+    def frames_per_sec(self):
+        """
+        The average simulation throughput of a single worker.
+        """
+        return self.num_frames / self.wall_time if self.wall_time else 0
+
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(
+            description="Play AI-vs-AI matches in parallel.")
+    parser.add_argument('--ais', type=int, default=2,
+            help="number of AIs in each match")
+    parser.add_argument('--matches', type=int, default=100,
+            help="number of matches to play")
+    parser.add_argument('--seed', type=int, default=0,
+            help="seed for the first match; each match after uses the next integer")
+    parser.add_argument('--workers', type=int, default=None,
+            help="number of worker processes (default: one per core)")
+    parser.add_argument('--dt', type=float, default=1/50,
+            help="simulated seconds per update")
+    parser.add_argument('--max-time', type=float, default=600,
+            help="simulated seconds before a match is abandoned")
+    args = parser.parse_args()
+
+    seeds = range(args.seed, args.seed + args.matches)
+    standings = Standings(args.ais)
+    results = run_tournament(
+            seeds, args.ais, args.dt, args.max_time, args.workers)
+
+    for seed, result in results:
+        standings.add_result(result)
+        winner = 'none' if result.winner is None else 'AI {}'.format(result.winner)
+        print("seed {}: winner={}, simulated={:.1f}s, wall={:.2f}s".format(
+            seed, winner, result.simulated_time, result.wall_time))
+
+    print()
+    for i, win_rate in enumerate(standings.win_rates):
+        print("AI {}: {:.1%} wins".format(i, win_rate))
+    print("draws: {}/{}".format(standings.num_draws, standings.num_matches))
+    print("throughput: {:.0f} frames/sec per worker".format(
+        standings.frames_per_sec))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,201 @@
+#!/usr/bin/env python3
+
+"""
+Account for what each type of message costs to send over the network.
+
+A MessageLog records, for each message class, how many messages were sent,
+how big they are when serialized for the network, and how long it took each
+one to go from being sent to being executed.  Like the PhaseTimer, it works
+by hooking methods when it's attached (see the instrumentation module), so it
+costs nothing until then.
+
+Rates are given per second of game time (i.e. the sum of the time steps the
+world has been updated with), so the numbers from a headless match that runs
+much faster than real time still describe what a real game would send.
+"""
+
+import time, json, collections
+from kxg.multiplayer import MessageSerializer
+from .instrumentation import Hooks, percentile, print_table
+
+class MessageLog:
+    """
+    Keep track of the size, rate, and latency of every type of message.
+
+    Sizes are measured by serializing each message exactly as it would be
+    serialized to be sent to a remote client.  Latency is measured by noting
+    the time each message was sent by one of the given actors, and comparing
+    that to the time it's executed, i.e. it's the time it takes to check the
+    message.  The times are kept in the log rather than on the messages, so
+    that logging doesn't change what's sent over the network.  That means
+    the latency of messages that arrived from another machine isn't measured.
+    """
+
+    def __init__(self, history_length=1000):
+        self.history_length = history_length
+        self.stats = collections.defaultdict(
+                lambda: MessageStats(history_length))
+        self.game_time = 0
+        self._serializer = None
+        self._pending_sizes = {}
+        self._sent_times = {}
+        self._hooks = Hooks()
+
+    @property
+    def is_attached(self):
+        return bool(self._hooks)
+
+    def attach(self, world, actors=()):
+        """
+        Start recording the messages executed in the given world.  Messages
+        sent by the given actors are timed so their latency can be measured.
+        At least one actor running on this machine must be given, or the sizes
+        of the messages won't be measured.
+        """
+        self.detach()
+        self._serializer = MessageSerializer(world)
+
+        # Forum.execute_message() relays each message to every actor before
+        # executing it, then lets the world react to it once it's been
+        # executed.  Hook into the first actor's relay to measure the message
+        # while it's still in the state it would be sent over the network in,
+        # and into the world's reaction to measure the latency.
+
+        def on_update_game(original, dt):
+            self.game_time += dt
+            return original(dt)
+
+        # Messages are executed before send_message() returns, unless they 
+        # fail their checks, so the send time is forgotten either way once it 
+        # does.
+
+        def send_message(original, message):
+            self._sent_times[id(message)] = time.time()
+            try:
+                return original(message)
+            finally:
+                self._sent_times.pop(id(message), None)
+
+        def relay_message(original, message):
+            self._pending_sizes[id(message)] = self.measure_size(message)
+            return original(message)
+
+        def react_to_message(original, message):
+            self.record(message, self._pending_sizes.pop(id(message), None))
+            return original(message)
+
+        self._hooks.add(world, 'on_update_game', on_update_game)
+        self._hooks.add(world, '_react_to_message', react_to_message)
+
+        for actor in actors:
+            self._hooks.add(actor, 'send_message', send_message)
+
+        if actors:
+            self._hooks.add(actors[0], '_relay_message', relay_message)
+
+    def detach(self):
+        """
+        Stop recording messages and restore all the original methods.
+        """
+        self._hooks.remove_all()
+        self._pending_sizes.clear()
+        self._sent_times.clear()
+
+    def measure_size(self, message):
+        return len(self._serializer.pack(message))
+
+    def record(self, message, size):
+        stats = self.stats[message.__class__.__name__]
+        stats.count += 1
+
+        if size is not None:
+            stats.num_bytes += size
+            stats.sizes.append(size)
+
+        sent_at = self._sent_times.get(id(message))
+        if sent_at is not None:
+            stats.latencies.append(time.time() - sent_at)
+
+    def clear(self):
+        self.stats.clear()
+        self.game_time = 0
+
+    def report(self):
+        """
+        Return a dictionary mapping the name of each message class to its
+        count, its rate (messages and bytes per second of game time), its mean
+        and maximum serialized size, and its p50/p95/max latency.
+        """
+        return {
+                name: stats.report(self.game_time)
+                for name, stats in self.stats.items()
+        }
+
+    def dump(self, file=None):
+        """
+        Print a table of the recorded statistics, most bandwidth first.
+        """
+        print("{:.1f}s of game time:".format(self.game_time), file=file)
+        print_report(self.report(), file)
+
+    def export(self, path):
+        """
+        Save the recorded statistics to the given path as JSON.
+        """
+        with open(path, 'w') as file:
+            json.dump({
+                'game_time': self.game_time,
+                'messages': self.report(),
+            }, file, indent=2)
+
+
+class MessageStats:
+    """
+    The statistics recorded for a single message class.  Totals are kept for
+    the whole game, but only the most recent sizes and latencies are kept for
+    calculating percentiles.
+    """
+
+    def __init__(self, history_length):
+        self.count = 0
+        self.num_bytes = 0
+        self.sizes = collections.deque(maxlen=history_length)
+        self.latencies = collections.deque(maxlen=history_length)
+
+    def report(self, game_time):
+        latencies = sorted(self.latencies)
+
+        return {
+                'count': self.count,
+                'bytes': self.num_bytes,
+                'per_sec': self.count / game_time if game_time else 0,
+                'bytes_per_sec': self.num_bytes / game_time if game_time else 0,
+                'mean_size': sum(self.sizes) / len(self.sizes) if self.sizes else 0,
+                'max_size': max(self.sizes, default=0),
+                'latency_p50': percentile(latencies, 50),
+                'latency_p95': percentile(latencies, 95),
+                'latency_max': latencies[-1] if latencies else 0,
+        }
+
+
+def print_report(report, file=None):
+    """
+    Print a table of the statistics returned by MessageLog.report(), with the
+    message types using the most bandwidth first.
+    """
+    report_ms = {
+            name: dict(stats,
+                latency_p50=1e3 * stats['latency_p50'],
+                latency_p95=1e3 * stats['latency_p95'])
+            for name, stats in report.items()
+    }
+    columns = [
+            ('count', 'count', '{:d}'),
+            ('per sec', 'per_sec', '{:.2f}'),
+            ('mean (B)', 'mean_size', '{:.0f}'),
+            ('B/sec', 'bytes_per_sec', '{:.0f}'),
+            ('p50 (ms)', 'latency_p50', '{:.3f}'),
+            ('p95 (ms)', 'latency_p95', '{:.3f}'),
+    ]
+    print_table(report_ms, 'message', columns,
+            sort_key=lambda stats: -stats['bytes_per_sec'], file=file)
@@ -1,7 +1,23 @@
 #!/usr/bin/env python3
 
-import kxg, pymunk, itertools
-from vecrec import Rect
+import kxg, pymunk, itertools, collections, math, random
+import numpy as np
+from vecrec import Rect, Vector
+from . import gravity, tokens
+from .interpolation import SnapshotBuffer
+
+WorldSnapshot = collections.namedtuple('WorldSnapshot', [
+    'version',          # FieldObjectRegistry.version when the snapshot was taken
+    'objects',          # the field objects, in the same order as `bodies`
+    'bodies',           # (N, 6) array: x, y, vx, vy, angle, angular velocity
+    'players',          # (player, arsenal, _arsenal, targets) for each player
+    'physics_lag',
+    'physics_step_size',
+    'dropped_physics_time',
+    'elapsed_time',
+    'winner',
+    'random_state',
+])
 
 class World (kxg.World):
     """
@@ -12,17 +28,112 @@ class World (kxg.World):
     gravity_constant = 1e5
     elasticity_constant = 1
 
-    def __init__(self):
+    # The algorithm used to calculate gravitational forces each frame.  Must be 
+    # one of the following:
+    #
+    # 'pairwise': Loop over every pair of field objects in python.  This is 
+    #     the reference implementation, but it's slow for more than a few 
+    #     dozen objects.
+    #
+    # 'vectorized': Compute every pairwise force in a single batched numpy 
+    #     pass.  Gives the same result as 'pairwise' to within floating point 
+    #     error.
+    #
+    # 'barnes_hut': Approximate distant groups of objects by their center of 
+    #     mass using a quadtree.  This scales as O(N log N), and the accuracy 
+    #     is controlled by `barnes_hut_theta`: 0 is exact, 0.5 is a good 
+    #     default, and larger values are faster but less accurate.
+    #
+    # 'test_particle': Treat bullets as test particles.  Bullets feel the 
+    #     gravity of targets and obstacles, but don't pull on anything 
+    #     themselves.  This scales as O(bullets × heavy objects).
+    #
+    # Despite its better scaling, 'barnes_hut' is slower than 'vectorized' 
+    # below roughly 1000 objects (12 ms vs 6 ms at 300 objects, but 41 ms 
+    # vs 48 ms at 1000), because building the tree and visiting its nodes is 
+    # done in python.  Run `python -m pie_in_the_sky.benchmarks --bullets N 
+    # gravity_vectorized gravity_barnes_hut` to see where it crosses over on 
+    # a particular machine.
+
+    gravity_solver = 'vectorized'
+    barnes_hut_theta = 0.5
+
+    # The physics simulation is advanced in fixed steps of `physics_dt`, 
+    # because the simulation is much more efficient if the step size doesn't 
+    # change between frames.  Time that doesn't fill a whole step is carried 
+    # over to the next frame.  No more than `max_physics_steps` are taken in 
+    # any one frame, so that one slow frame can't make the next frame even 
+    # slower.  Any time beyond that limit is dropped.
+
+    physics_dt = 1 / 300
+    max_physics_steps = 30
+
+    # If `adaptive_physics` is enabled, the step size is instead chosen once 
+    # per frame such that no object can move more than `max_physics_travel` 
+    # times the radius of the smallest object in a single step (to prevent 
+    # tunneling), within the range [`min_physics_dt`, `max_physics_dt`].  This 
+    # allows far fewer steps to be taken when only slow objects are in play.
+
+    adaptive_physics = False
+    min_physics_dt = 1 / 300
+    max_physics_dt = 1 / 30
+    max_physics_travel = 0.25
+
+    # The number of steps taken in each of the most recent frames are recorded 
+    # in `World.physics_step_history`.
+
+    physics_history_length = 300
+
+    # When a sync message corrects the position of a field object, the 
+    # physics engine takes the corrected position right away, but the object 
+    # can be drawn offset by the size of the correction, with the offset 
+    # decaying exponentially (with time constant `sync_smoothing_time`) so 
+    # that the object glides into place instead of jumping.  Corrections 
+    # bigger than `max_smoothing_distance` (e.g. from a bounce that only 
+    # happened on the server) are snapped, since gliding across the field 
+    # would look worse than jumping.  Offsets are dropped once they're 
+    # smaller than `min_smoothing_distance`.
+
+    sync_smoothing = True
+    sync_smoothing_time = 0.15
+    max_smoothing_distance = 60
+    min_smoothing_distance = 0.1
+
+    # In `thin_client` mode, worlds without a referee (i.e. the clients in a 
+    # multiplayer game) don't simulate gravity or physics at all.  Instead, 
+    # the referee sends the state of every field object several times a 
+    # second (see Referee.snapshot_interval), and the clients draw the field 
+    # objects `interpolation_delay` seconds in the past, interpolated between 
+    # the snapshots on either side (see the interpolation module).  The delay 
+    # should be at least a couple of snapshot intervals, so that snapshots 
+    # arriving late don't leave a gap.  Objects that haven't been in a 
+    # snapshot yet (e.g. bullets that were just shot) coast in straight lines 
+    # until they are.  Thin client mode can be turned on for a single world by 
+    # passing `thin_client=True` to the constructor.
+
+    thin_client = False
+    interpolation_delay = 0.1
+
+    def __init__(self, seed=None, thin_client=None):
         super().__init__()
 
+        if thin_client is not None:
+            self.thin_client = thin_client
+
+        # All the randomness in the game (e.g. where the targets start and how 
+        # the AI aims) comes from this generator, so games can be reproduced 
+        # exactly by providing a seed.
+
+        self.seed = seed
+        self.random = random.Random(seed)
+
         # Initialize the game objects.
 
         self.field = Rect.from_size(*self.field_size)
         self.players = []
-        self.bullets = []
-        self.targets = []
+        self.field_objects = FieldObjectRegistry()
+        self.field_state = FieldState()
         self.final_target = None
-        self.obstacles = []
         self.winner = None
 
         # Initialize the 2D physics simulator.
@@ -31,11 +142,39 @@ class World (kxg.World):
         self.space.gravity = 0, 0
         self.make_boundary()
 
+        self.physics_lag = 0
+        self.physics_step_size = self.physics_dt
+        self.physics_step_history = collections.deque(
+                maxlen=self.physics_history_length)
+        self.dropped_physics_time = 0
+
+        self.visual_offsets = {}
+
+        self.elapsed_time = 0
+        self.snapshot_buffer = SnapshotBuffer(self.interpolation_delay)
+        self.coasting_objects = set()
+
+    @property
+    def bullets(self):
+        return self.field_objects.of_type(tokens.Bullet)
+
     @property
-    def field_objects(self):
-        yield from self.bullets
-        yield from self.targets
-        yield from self.obstacles
+    def targets(self):
+        return self.field_objects.of_type(tokens.Target)
+
+    @property
+    def obstacles(self):
+        return self.field_objects.of_type(tokens.Obstacle)
+
+    @kxg.read_only
+    def random_vector(self, magnitude=1):
+        """
+        Return a vector with the given magnitude pointing in a random 
+        direction.  This is like Vector.random(), but uses the world's random 
+        number generator.
+        """
+        theta = self.random.uniform(0, 2 * math.pi)
+        return magnitude * Vector.from_radians(theta)
 
     @kxg.read_only
     def make_boundary(self):
@@ -52,30 +191,512 @@ class World (kxg.World):
         self.space.add(walls)
 
     def on_update_game(self, dt):
-        super().on_update_game(dt)
+        # Each phase of the update is its own method, so that the phases can 
+        # be timed individually (see PhaseTimer).
 
-        # Update players
+        self.elapsed_time += dt
+        self.update_tokens(dt)
+        self.update_players(dt)
 
-        for player in self.players:
-            player.recharge_arsenal(dt)
+        if self.is_thin_client:
+            self.interpolate_field_objects(dt)
+            self.decay_visual_offsets(dt)
+            return
 
         # Update physics
 
-        G = self.gravity_constant
+        self.reset_forces()
+
+        if self.field_state.is_stale(self.field_objects):
+            self.update_field_state()
+
+        self.apply_gravity()
+        self.step_physics(dt)
+        self.update_field_state()
+        self.decay_visual_offsets(dt)
+
+    def update_tokens(self, dt):
+        super().on_update_game(dt)
 
+    def update_players(self, dt):
+        for player in self.players:
+            player.recharge_arsenal(dt)
+
+    def reset_forces(self):
         for obj in self.field_objects:
             obj.body.reset_forces()
 
+    @property
+    def has_referee(self):
+        """
+        Whether this world is the authoritative one, i.e. the referee runs on 
+        this machine.
+        """
+        return any(actor.is_referee() for actor in self._actors)
+
+    @property
+    def is_thin_client(self):
+        return self.thin_client and not self.has_referee
+
+    def interpolate_field_objects(self, dt):
+        """
+        Move the field objects to where the snapshots from the referee say 
+        they are, rather than simulating them.  Only thin clients do this.
+        """
+        self.snapshot_buffer.advance(dt)
+        sample = self.snapshot_buffer.sample()
+        sampled = set()
+
+        if sample is not None:
+            for id, position, velocity in zip(*(x.tolist() for x in sample)):
+                try:
+                    obj = self.get_token(id)
+                except (KeyError, IndexError):
+                    continue
+
+                # Objects that have been coasting are probably a little off 
+                # from where the snapshots put them, so smooth the transition.
+
+                if obj in self.coasting_objects:
+                    self.correct_field_object(obj, position, velocity)
+                else:
+                    obj.body.position = tuple(position)
+                    obj.body.velocity = tuple(velocity)
+
+                sampled.add(obj)
+
+        self.coasting_objects = set(self.field_objects) - sampled
+
+        for obj in self.coasting_objects:
+            x, y = obj.body.position
+            vx, vy = obj.body.velocity
+            obj.body.position = x + dt * vx, y + dt * vy
+
+        self.update_field_state()
+
+    @kxg.read_only
+    def update_field_state(self):
+        """
+        Copy the positions and velocities of every field object out of the 
+        physics engine and into World.field_state.  This happens once per 
+        frame, after the physics engine has been stepped, but messages that 
+        move field objects directly should call it too.
+        """
+        self.field_state.fill(self.field_objects)
+
+    def correct_field_object(self, obj, position, velocity):
+        """
+        Move the given field object to the given position and velocity, 
+        e.g. to bring it in line with the server.  If `sync_smoothing` is 
+        enabled, the object keeps being drawn where it was and is smoothly 
+        brought to where it really is over the next few frames.
+        """
+        # pymunk only accepts tuples and Vec2d's, not the lists that come out 
+        # of numpy arrays.
+
+        position, velocity = tuple(position), tuple(velocity)
+
+        if self.sync_smoothing:
+            x, y = obj.body.position
+            offset = self.visual_offset_of(obj) + (x - position[0], y - position[1])
+
+            if self.min_smoothing_distance < offset.magnitude < self.max_smoothing_distance:
+                self.visual_offsets[obj] = offset
+            else:
+                self.visual_offsets.pop(obj, None)
+
+        obj.body.position, obj.body.velocity = position, velocity
+
+    def decay_visual_offsets(self, dt):
+        if not self.visual_offsets:
+            return
+
+        decay = math.exp(-dt / self.sync_smoothing_time)
+
+        for obj, offset in list(self.visual_offsets.items()):
+            offset = decay * offset
+            if offset.magnitude < self.min_smoothing_distance:
+                del self.visual_offsets[obj]
+            else:
+                self.visual_offsets[obj] = offset
+
+    @kxg.read_only
+    def visual_offset_of(self, obj):
+        """
+        Return how far from its real position the given field object should 
+        be drawn, while a correction to its position is being smoothed over.
+        """
+        return self.visual_offsets.get(obj, Vector.null())
+
+    @kxg.read_only
+    def snapshot(self):
+        """
+        Capture everything about the world that changes as the game is played: 
+        the state of every physics body, each player's arsenal and targets, 
+        the physics and game clocks, the winner, and the random number 
+        generator.  The result can be passed to `restore()` to put the world 
+        back the way it was.  (Visual offsets and the thin-client snapshot 
+        buffer and coasting objects only affect drawing, so they're cleared 
+        instead.)
+
+        The body state is copied into a single (N, 6) array of x, y, vx, vy, 
+        angle, and angular velocity, so snapshots are small and cheap to take.  
+        Tokens are referenced directly rather than being copied, so a snapshot 
+        is only meaningful for the world it was taken from.
+        """
+        objects = self.field_objects.snapshot()
+        bodies = np.array([
+                (b.position.x, b.position.y, b.velocity.x, b.velocity.y,
+                    b.angle, b.angular_velocity)
+                for b in (obj.body for obj in objects)
+        ], dtype=float).reshape(-1, 6)
+        players = tuple(
+                (player, player.arsenal, player._arsenal, tuple(player.targets))
+                for player in self.players
+        )
+        return WorldSnapshot(
+                version=self.field_objects.version,
+                objects=objects,
+                bodies=bodies,
+                players=players,
+                physics_lag=self.physics_lag,
+                physics_step_size=self.physics_step_size,
+                dropped_physics_time=self.dropped_physics_time,
+                elapsed_time=self.elapsed_time,
+                winner=self.winner,
+                random_state=self.random.getstate(),
+        )
+
+    def restore(self, snapshot):
+        """
+        Put the world back into the state captured by the given snapshot.
+
+        Field objects can only be added to or removed from the world by 
+        messages, so the world must have the same field objects it had when 
+        the snapshot was taken.  A ValueError is raised if it doesn't.  As 
+        with any other change to the world, this can only be called while the 
+        world is unlocked.
+        """
+        if snapshot.version != self.field_objects.version:
+            if set(snapshot.objects) != set(self.field_objects):
+                raise ValueError("can't restore a snapshot taken with different field objects.")
+
+        for obj, (x, y, vx, vy, angle, angular_velocity) in zip(
+                snapshot.objects, snapshot.bodies.tolist()):
+            body = obj.body
+            body.position = x, y
+            body.velocity = vx, vy
+            body.angle = angle
+            body.angular_velocity = angular_velocity
+
+        for player, arsenal, _arsenal, targets in snapshot.players:
+            player.arsenal = arsenal
+            player._arsenal = _arsenal
+            player.targets[:] = targets
+
+        self.physics_lag = snapshot.physics_lag
+        self.physics_step_size = snapshot.physics_step_size
+        self.dropped_physics_time = snapshot.dropped_physics_time
+        self.elapsed_time = snapshot.elapsed_time
+        self.visual_offsets.clear()
+        self.snapshot_buffer.clear()
+        self.coasting_objects.clear()
+        self.winner = snapshot.winner
+        self.random.setstate(snapshot.random_state)
+
+        # If the field state is up to date and has the same objects in the 
+        # same order as the snapshot, copy the positions and velocities 
+        # straight into it rather than reading them back out of the bodies.  
+        # Snapshots that have been saved and loaded (e.g. by the replay 
+        # module) don't have a version, so they always take the slow path.
+
+        state = self.field_state
+        if snapshot.version is not None and \
+                state.version == snapshot.version == self.field_objects.version:
+            state.positions[:] = snapshot.bodies[:,0:2]
+            state.velocities[:] = snapshot.bodies[:,2:4]
+        else:
+            self.update_field_state()
+
+    @property
+    def physics_alpha(self):
+        """
+        The fraction of a physics step that has elapsed but hasn't been 
+        simulated yet.  Renderers can use this to extrapolate the positions of 
+        the field objects between physics steps.
+        """
+        return self.physics_lag / self.physics_step_size
+
+    @kxg.read_only
+    def pick_physics_step_size(self):
+        if not self.adaptive_physics:
+            return self.physics_dt
+
+        state = self.field_state
+        if not state.objects:
+            return self.max_physics_dt
+
+        speeds_squared = np.einsum('ij,ij->i', state.velocities, state.velocities)
+        max_speed = np.sqrt(speeds_squared.max())
+        min_radius = state.radii.min()
+
+        if max_speed == 0:
+            return self.max_physics_dt
+
+        step_size = self.max_physics_travel * min_radius / max_speed
+        return min(max(step_size, self.min_physics_dt), self.max_physics_dt)
+
+    def step_physics(self, dt):
+        self.physics_step_size = step_size = self.pick_physics_step_size()
+        self.physics_lag += dt
+        num_steps = int(self.physics_lag // step_size)
+
+        if num_steps > self.max_physics_steps:
+            dropped_time = (num_steps - self.max_physics_steps) * step_size
+            self.dropped_physics_time += dropped_time
+            self.physics_lag -= dropped_time
+            num_steps = self.max_physics_steps
+            kxg.warning("physics fell behind; dropped {dropped_time:.3f}s of simulated time.")
+
+        for i in range(num_steps):
+            self.space.step(step_size)
+
+        self.physics_lag -= num_steps * step_size
+        self.physics_step_history.append(num_steps)
+
+    def apply_gravity(self):
+        if self.gravity_solver == 'pairwise':
+            self.apply_pairwise_gravity()
+        elif self.gravity_solver == 'vectorized':
+            self.apply_array_gravity(gravity.vectorized_forces)
+        elif self.gravity_solver == 'barnes_hut':
+            self.apply_array_gravity(
+                    gravity.barnes_hut_forces, self.barnes_hut_theta)
+        elif self.gravity_solver == 'test_particle':
+            is_source = [
+                    not isinstance(obj, tokens.Bullet)
+                    for obj in self.field_state.objects
+            ]
+            self.apply_array_gravity(gravity.test_particle_forces, is_source)
+        else:
+            raise ValueError("unknown gravity solver: '{}'".format(
+                self.gravity_solver))
+
+    @kxg.read_only
+    def calculate_gravity(self, objects, positions, masses):
+        """
+        Return the net gravitational force on each of the given objects if 
+        they were at the given positions, calculated with the world's gravity 
+        solver.  The 'pairwise' solver only works on the pymunk bodies, so 
+        the 'vectorized' solver (which gives the same result) is used in its 
+        place.
+        """
+        G = self.gravity_constant
+
+        if self.gravity_solver in ('pairwise', 'vectorized'):
+            return gravity.vectorized_forces(positions, masses, G)
+        elif self.gravity_solver == 'barnes_hut':
+            return gravity.barnes_hut_forces(
+                    positions, masses, G, self.barnes_hut_theta)
+        elif self.gravity_solver == 'test_particle':
+            is_source = [not isinstance(x, tokens.Bullet) for x in objects]
+            return gravity.test_particle_forces(positions, masses, G, is_source)
+        else:
+            raise ValueError("unknown gravity solver: '{}'".format(
+                self.gravity_solver))
+
+    def apply_pairwise_gravity(self):
+        G = self.gravity_constant
+
         for obj_1, obj_2 in itertools.combinations(self.field_objects, 2):
             dist = obj_2.position - obj_1.position
             force = G * obj_1.mass * obj_2.mass * dist.unit / dist.magnitude_squared
             obj_1.body.apply_force(force.xy, (0,0))
             obj_2.body.apply_force((-force).xy, (0,0))
 
-        # Note that we don't use dt as the time step because the simulation is 
-        # much more efficient if the step size doesn't change between frames.
+    def apply_array_gravity(self, solver, *args):
+        """
+        Let the given solver calculate the net force on each field object from 
+        the arrays in World.field_state, then apply those forces to the pymunk 
+        bodies.
+        """
+        state = self.field_state
+        if not state.objects:
+            return
+
+        forces = solver(
+                state.positions, state.masses, self.gravity_constant, *args)
+
+        for obj, (fx, fy) in zip(state.objects, forces.tolist()):
+            obj.body.apply_force((fx, fy), (0,0))
+
+
+class FieldObjectRegistry:
+    """
+    Keep track of every object in the field of play.
+
+    Objects are stored densely, so they can be added and removed in constant 
+    time (removing an object moves the last object into its slot).  Objects 
+    don't have stable indices, because removing an object moves another one; 
+    FieldState assigns each object a row in its arrays whenever the set of 
+    objects changes, and `version` tells when that has happened.
+
+    Iterating over the registry (or over the objects of a particular type or 
+    owner) returns a cached snapshot, so it's safe to add or remove objects 
+    while iterating, and repeated iteration is cheap while nothing changes.
+    """
+
+    def __init__(self):
+        self._objects = _DenseSet()
+        self.version = 0
+        self._by_type = collections.defaultdict(_DenseSet)
+        self._by_owner = collections.defaultdict(_DenseSet)
+
+    def __iter__(self):
+        return iter(self.snapshot())
+
+    def __len__(self):
+        return len(self._objects)
+
+    def __contains__(self, obj):
+        return obj in self._objects
+
+    def add(self, obj):
+        if obj in self._objects:
+            raise ValueError("{} already in registry".format(obj))
+
+        self._objects.add(obj)
+        self._by_type[type(obj)].add(obj)
+        self._by_owner[obj.owner].add(obj)
+        self.version += 1
+
+    def remove(self, obj):
+        self._objects.remove(obj)
+        self._by_type[type(obj)].remove(obj)
+        self._by_owner[obj.owner].remove(obj)
+        self.version += 1
+
+    def snapshot(self):
+        return self._objects.snapshot()
+
+    def of_type(self, cls):
+        """
+        Return every object whose class is exactly the given class.
+        """
+        return self._by_type[cls].snapshot() if cls in self._by_type else ()
+
+    def of_owner(self, owner):
+        """
+        Return every object belonging to the given player.  Bullets belong to 
+        the player that shot them, targets belong to the player that needs to 
+        hit them, and obstacles (and the final target) belong to None.
+        """
+        return self._by_owner[owner].snapshot() if owner in self._by_owner else ()
+
+
+class FieldState:
+    """
+    A struct-of-arrays snapshot of every field object.
+
+    The world copies the positions and velocities of every field object out 
+    of pymunk into contiguous numpy arrays once per frame, so that bulk 
+    consumers (the gravity solvers, SyncWorlds, the referee's drift checks) 
+    can work on whole arrays at once instead of visiting each body.  Row i of 
+    each array corresponds to `objects[i]`, and `rows` maps each object back 
+    to its row.  The arrays are not copied.
+
+    Reading a single object through `position_of()` isn't any faster than 
+    reading its pymunk body; the point of it is that every reader sees the 
+    same state for the whole frame.  It returns Vectors of plain floats, 
+    since these end up in messages, and numpy scalars pickle to more than 
+    twice the size.
+    """
+
+    def __init__(self):
+        self.objects = ()
+        self.rows = {}
+        self.version = None
+        self.positions = np.zeros((0, 2))
+        self.velocities = np.zeros((0, 2))
+        self.masses = np.zeros(0)
+        self.radii = np.zeros(0)
+
+    def is_stale(self, registry):
+        return self.version != registry.version
+
+    def fill(self, registry):
+        # The masses and radii never change, so they only have to be gathered 
+        # when objects are added to or removed from the field.
+
+        if self.is_stale(registry):
+            self.objects = objects = registry.snapshot()
+            self.rows = {obj: i for i, obj in enumerate(objects)}
+            self.version = registry.version
+            self.positions = np.empty((len(objects), 2))
+            self.velocities = np.empty((len(objects), 2))
+            self.masses = np.array([x.mass for x in objects], dtype=float)
+            self.radii = np.array([x.radius for x in objects], dtype=float)
+
+        positions, velocities = self.positions, self.velocities
+
+        for i, obj in enumerate(self.objects):
+            p, v = obj.body.position, obj.body.velocity
+            positions[i] = p.x, p.y
+            velocities[i] = v.x, v.y
+
+    def position_of(self, obj):
+        """
+        Return the position of the given object as a Vector, or None if the 
+        object isn't in the snapshot (e.g. it was added since the last fill).
+        """
+        row = self.rows.get(obj)
+        if row is not None:
+            return Vector(*self.positions[row].tolist())
+
+    def velocity_of(self, obj):
+        """
+        Return the velocity of the given object as a Vector, or None if the 
+        object isn't in the snapshot.
+        """
+        row = self.rows.get(obj)
+        if row is not None:
+            return Vector(*self.velocities[row].tolist())
+
+
+class _DenseSet:
+    """
+    A set that can add and remove items in constant time and that caches a 
+    tuple of its items until it changes.  Removing an item moves the last 
+    item into its place, so the order isn't preserved.
+    """
+
+    def __init__(self):
+        self._items = []
+        self._indices = {}
+        self._snapshot = ()
+
+    def __len__(self):
+        return len(self._items)
+
+    def __contains__(self, item):
+        return item in self._indices
+
+    def add(self, item):
+        self._indices[item] = len(self._items)
+        self._items.append(item)
+        self._snapshot = None
+
+    def remove(self, item):
+        index = self._indices.pop(item)
+        last = self._items.pop()
+
+        if last is not item:
+            self._items[index] = last
+            self._indices[last] = index
 
-        physics_dt = 1 / 300
-        for i in range(int(dt // physics_dt)):
-            self.space.step(physics_dt)
+        self._snapshot = None
 
+    def snapshot(self):
+        if self._snapshot is None:
+            self._snapshot = tuple(self._items)
+        return self._snapshot
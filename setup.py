@@ -26,6 +26,8 @@ setup(
     entry_points = {
         'console_scripts': [
             'pie_in_the_sky=pie_in_the_sky:main',
+            'pie_in_the_sky_headless=pie_in_the_sky.headless:main',
+            'pie_in_the_sky_tournament=pie_in_the_sky.tournament:main',
         ],
     },
     include_package_data=True,
@@ -35,6 +37,7 @@ setup(
         'vecrec',
         'glooey',
         'nonstdlib',
+        'numpy',
     ],
     license='GPLv3',
     zip_safe=False,
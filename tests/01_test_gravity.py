@@ -0,0 +1,74 @@
+#!/usr/bin/env python3
+
+import pytest
+import numpy as np
+from pie_in_the_sky import gravity
+from pie_in_the_sky.world import World
+
+G = World.gravity_constant
+
+def random_field(n, seed=0, num_heavy=10):
+    rng = np.random.default_rng(seed)
+    w, h = World.field_size
+    positions = rng.uniform((0, 0), (w, h), size=(n, 2))
+    masses = np.ones(n)
+    masses[:num_heavy] = rng.choice([2, 5], size=min(n, num_heavy))
+    return positions, masses
+
+def pairwise_forces(positions, masses):
+    # The same calculation as World.apply_pairwise_gravity(), without the 
+    # pymunk bodies.
+    forces = np.zeros_like(positions)
+    for i in range(len(positions)):
+        for j in range(i + 1, len(positions)):
+            dist = positions[j] - positions[i]
+            force = G * masses[i] * masses[j] * dist / np.linalg.norm(dist)**3
+            forces[i] += force
+            forces[j] -= force
+    return forces
+
+def relative_error(forces, exact):
+    error = np.linalg.norm(forces - exact, axis=1)
+    return error / np.linalg.norm(exact, axis=1)
+
+
+def test_vectorized_matches_pairwise():
+    positions, masses = random_field(100)
+    np.testing.assert_allclose(
+            gravity.vectorized_forces(positions, masses, G),
+            pairwise_forces(positions, masses),
+            rtol=1e-9, atol=1e-9)
+
+def test_vectorized_ignores_coincident_objects():
+    positions = np.array([[0, 0], [0, 0], [10, 0]], dtype=float)
+    masses = np.ones(3)
+    forces = gravity.vectorized_forces(positions, masses, G)
+    assert np.all(np.isfinite(forces))
+    np.testing.assert_allclose(forces.sum(axis=0), 0, atol=1e-9)
+
+@pytest.mark.parametrize('n', [5, 100, 500])
+def test_barnes_hut_exact_at_theta_0(n):
+    positions, masses = random_field(n)
+    np.testing.assert_allclose(
+            gravity.barnes_hut_forces(positions, masses, G, theta=0),
+            gravity.vectorized_forces(positions, masses, G),
+            rtol=1e-9, atol=1e-9)
+
+def test_barnes_hut_error_at_default_theta():
+    positions, masses = random_field(500)
+    exact = gravity.vectorized_forces(positions, masses, G)
+    forces = gravity.barnes_hut_forces(
+            positions, masses, G, theta=World.barnes_hut_theta)
+    assert relative_error(forces, exact).max() < 0.2
+
+def test_barnes_hut_empty_field():
+    forces = gravity.barnes_hut_forces(np.zeros((0, 2)), np.zeros(0), G)
+    assert forces.shape == (0, 2)
+
+def test_test_particles_dont_pull():
+    positions, masses = random_field(50)
+    is_source = masses > 1
+    forces = gravity.test_particle_forces(positions, masses, G, is_source)
+    exact = gravity.vectorized_forces(
+            positions[is_source], masses[is_source], G)
+    np.testing.assert_allclose(forces[is_source], exact, rtol=1e-9, atol=1e-9)
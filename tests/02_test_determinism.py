@@ -0,0 +1,21 @@
+#!/usr/bin/env python3
+
+from pie_in_the_sky import headless
+
+def play(seed):
+    return headless.play_match(
+            num_ais=2, max_simulated_time=5, seed=seed, digest=True)
+
+def test_same_seed_same_digest():
+    first, second = headless.check_determinism(max_simulated_time=5, seed=1)
+    assert first.digest is not None
+    assert first.digest == second.digest
+    assert first.num_frames == second.num_frames
+
+def test_different_seed_different_digest():
+    assert play(1).digest != play(2).digest
+
+def test_play_to_completion():
+    result = headless.play_match(num_ais=2, max_simulated_time=600, seed=2)
+    assert result.winner in (0, 1)
+    assert result.simulated_time < 600
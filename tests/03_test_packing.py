@@ -0,0 +1,64 @@
+#!/usr/bin/env python3
+
+import pytest
+import numpy as np
+from vecrec import Rect
+from pie_in_the_sky import packing
+from pie_in_the_sky.world import World
+
+field = Rect.from_size(*World.field_size)
+
+def random_state(num_objects=1000, seed=0):
+    rng = np.random.RandomState(seed)
+    ids = rng.randint(1, 2**32, num_objects)
+    positions = rng.uniform(
+            (field.left, field.bottom), (field.right, field.top),
+            (num_objects, 2))
+    velocities = rng.uniform(
+            -packing.velocity_range, packing.velocity_range, (num_objects, 2))
+    return ids, positions, velocities
+
+
+@pytest.mark.parametrize('encoding', packing.ENCODINGS)
+def test_round_trip(encoding):
+    ids, positions, velocities = random_state()
+    id_bytes, state_bytes = packing.pack_state(
+            ids, positions, velocities, field, encoding)
+    unpacked_ids, unpacked_positions, unpacked_velocities = \
+            packing.unpack_state(id_bytes, state_bytes, field, encoding)
+
+    error = np.abs(np.hstack((
+        unpacked_positions - positions,
+        unpacked_velocities - velocities))).max(axis=0)
+
+    np.testing.assert_array_equal(unpacked_ids, ids)
+    assert np.all(error <= packing.max_error(field, encoding))
+
+@pytest.mark.parametrize('encoding, bytes_per_object', [
+    ('float32', 20),
+    ('int16', 12),
+])
+def test_size(encoding, bytes_per_object):
+    ids, positions, velocities = random_state(100)
+    id_bytes, state_bytes = packing.pack_state(
+            ids, positions, velocities, field, encoding)
+    assert len(id_bytes) + len(state_bytes) == 100 * bytes_per_object
+
+def test_int16_clips_fast_velocities():
+    ids = [1]
+    positions = np.array([[100, 100]])
+    velocities = np.array([[10 * packing.velocity_range, 0]])
+    id_bytes, state_bytes = packing.pack_state(
+            ids, positions, velocities, field, 'int16')
+    _, _, unpacked = packing.unpack_state(id_bytes, state_bytes, field, 'int16')
+    assert unpacked[0,0] == pytest.approx(packing.velocity_range)
+
+def test_empty_state():
+    id_bytes, state_bytes = packing.pack_state(
+            [], np.zeros((0, 2)), np.zeros((0, 2)), field)
+    ids, positions, velocities = packing.unpack_state(id_bytes, state_bytes, field)
+    assert len(ids) == len(positions) == len(velocities) == 0
+
+def test_unknown_encoding():
+    with pytest.raises(ValueError):
+        packing.pack_state([1], np.zeros((1, 2)), np.zeros((1, 2)), field, 'int8')
@@ -0,0 +1,109 @@
+#!/usr/bin/env python3
+
+import kxg, functools
+import numpy as np
+from pie_in_the_sky import headless, messages
+from pie_in_the_sky.world import World
+
+class MirrorForum (kxg.Forum):
+    """
+    A forum that sends every message it executes to a second world, the way
+    the server would send it to a client.  The second world has no actors, so
+    (like a client's world) it has no referee.  Messages are sent in the order
+    they started executing, but only once the outermost one has finished, since
+    actors can send messages in response to other messages.
+    """
+
+    def __init__(self, client_world):
+        super().__init__()
+        self.client_world = client_world
+        self.client_forum = kxg.Forum()
+        self.packets = []
+        self.depth = 0
+
+    def connect_everyone(self, world, actors):
+        super().connect_everyone(world, actors)
+        self.serializer = kxg.MessageSerializer(world)
+        self.client_serializer = kxg.MessageSerializer(self.client_world)
+
+        with self.client_world._unlock_temporarily():
+            self.client_forum.connect_everyone(self.client_world, [])
+            self.client_world.on_start_game()
+
+    def execute_message(self, message):
+        self.packets.append(self.serializer.pack(message))
+        self.depth += 1
+        super().execute_message(message)
+        self.depth -= 1
+
+        if self.depth == 0:
+            packets, self.packets = self.packets, []
+            for packet in packets:
+                self.client_forum.execute_message(
+                        self.client_serializer.unpack(packet))
+
+
+def play_mirrored(client_world, num_frames=50, dt=1/50, seed=1,
+        world_cls=World):
+    forum = MirrorForum(client_world)
+    match = headless.setup_match(world_cls=world_cls, seed=seed, forum=forum)
+
+    for i in range(num_frames):
+        match.theater.update(dt)
+        with client_world._unlock_temporarily():
+            client_world.on_update_game(dt)
+
+    return match.world
+
+def body_state(world):
+    return np.array([
+        tuple(obj.body.position) + tuple(obj.body.velocity)
+        for obj in sorted(world.field_objects, key=lambda x: x.id)
+    ])
+
+
+def test_apply_on_client():
+    client_world = World()
+    world = play_mirrored(client_world)
+
+    assert world.has_referee
+    assert not client_world.has_referee
+    assert len(client_world.field_objects) == len(world.field_objects) > 0
+
+    for obj in client_world.field_objects:
+        obj.body.position = 0, 0
+        obj.body.velocity = 0, 0
+
+    with client_world._unlock_temporarily():
+        messages.SyncWorlds(world).apply(client_world)
+
+    np.testing.assert_allclose(
+            body_state(client_world), body_state(world), atol=1e-3)
+    np.testing.assert_allclose(
+            client_world.field_state.positions,
+            [tuple(obj.body.position) for obj in client_world.field_state.objects])
+
+def test_referee_ignores_sync():
+    world = play_mirrored(World())
+    before = body_state(world)
+
+    with world._unlock_temporarily():
+        messages.SyncWorlds(world, 'int16').on_execute(world)
+
+    np.testing.assert_array_equal(body_state(world), before)
+
+def test_thin_client():
+    client_world = World(thin_client=True)
+    world = play_mirrored(client_world, num_frames=100,
+            world_cls=functools.partial(World, thin_client=True))
+
+    assert client_world.is_thin_client
+    assert not world.is_thin_client
+    assert not World.thin_client
+    assert len(client_world.snapshot_buffer) > 0
+
+    # The client draws the objects a little in the past, so they won't be 
+    # exactly where the referee has them.
+
+    np.testing.assert_allclose(
+            body_state(client_world)[:,0:2], body_state(world)[:,0:2], atol=50)
@@ -0,0 +1,124 @@
+#!/usr/bin/env python3
+
+import pytest
+import numpy as np
+from pie_in_the_sky import headless, replay
+from pie_in_the_sky.world import World, FieldState
+
+def play(num_frames, dt=1/50, seed=1):
+    match = headless.setup_match(seed=seed)
+    advance(match, num_frames, dt)
+    return match
+
+def advance(match, num_frames, dt=1/50):
+    for i in range(num_frames):
+        match.theater.update(dt)
+
+def body_state(world):
+    return np.array([
+        tuple(obj.body.position) + tuple(obj.body.velocity)
+        for obj in sorted(world.field_objects, key=lambda x: x.id)
+    ])
+
+
+def test_restore():
+    match = play(50)
+    world = match.world
+    snapshot = world.snapshot()
+    expected = body_state(world)
+
+    advance(match, 10)
+    assert not np.allclose(body_state(world), expected)
+
+    with world._unlock_temporarily():
+        world.restore(snapshot)
+
+    np.testing.assert_array_equal(body_state(world), expected)
+    assert world.elapsed_time == snapshot.elapsed_time
+    assert world.physics_lag == snapshot.physics_lag
+    np.testing.assert_array_equal(
+            world.field_state.positions, snapshot.bodies[:,0:2])
+
+def test_restore_without_version():
+    # Snapshots that have been saved and loaded don't have a version, and
+    # neither does a field state that's never been filled.
+    match = play(50)
+    world = match.world
+    snapshot = world.snapshot()._replace(version=None)
+    world.field_state = FieldState()
+
+    with world._unlock_temporarily():
+        world.restore(snapshot)
+
+    assert len(world.field_state.positions) == len(snapshot.objects) > 0
+    np.testing.assert_array_equal(
+            np.sort(world.field_state.positions, axis=0),
+            np.sort(snapshot.bodies[:,0:2], axis=0))
+
+def record(path, num_frames, dt=1/50, seed=3, keyframe_interval=2):
+    """
+    Record a match, and return the positions of the field objects at the end
+    of every second of it.
+    """
+    match = headless.setup_match(seed=seed)
+    recorder = replay.ReplayRecorder(path, keyframe_interval)
+    recorder.attach(match.world, [match.referee] + match.ais)
+    checkpoints = {}
+
+    for i in range(1, num_frames + 1):
+        match.theater.update(dt)
+        if i % 50 == 0:
+            checkpoints[recorder.time] = positions(match.world)
+
+    recorder.close()
+    return checkpoints
+
+def positions(world):
+    return {obj.id: tuple(obj.body.position) for obj in world.field_objects}
+
+def assert_positions_close(world, expected, atol):
+    actual = positions(world)
+    assert actual.keys() == expected.keys()
+    for id in expected:
+        np.testing.assert_allclose(actual[id], expected[id], atol=atol)
+
+
+def test_seek(tmp_path):
+    path = tmp_path / 'match.replay'
+    checkpoints = record(path, 400)
+    player = replay.ReplayPlayer(path)
+
+    assert len(player.keyframes) == 5
+    assert player.duration == pytest.approx(8)
+
+    for time, expected in checkpoints.items():
+        world = player.seek(time - 1e-6)
+        assert player.time == pytest.approx(time)
+        assert_positions_close(world, expected, atol=1e-3)
+
+def test_play_from_start(tmp_path):
+    path = tmp_path / 'match.replay'
+    checkpoints = record(path, 400)
+    player = replay.ReplayPlayer(path)
+    player.seek(0)
+
+    for time, expected in checkpoints.items():
+        player.advance(time - player.time - 1e-6)
+        assert player.time == pytest.approx(time)
+        assert_positions_close(player.world, expected, atol=1e-3)
+
+def test_settings(tmp_path):
+    path = tmp_path / 'match.replay'
+    match = headless.setup_match(seed=1)
+    match.world.gravity_solver = 'barnes_hut'
+    match.world.physics_dt = 1 / 200
+
+    recorder = replay.ReplayRecorder(path)
+    recorder.attach(match.world, [match.referee] + match.ais)
+    match.theater.update(1/50)
+    recorder.close()
+
+    world = replay.ReplayPlayer(path).seek(0)
+    assert world.gravity_solver == 'barnes_hut'
+    assert world.physics_dt == 1 / 200
+    assert World.gravity_solver == 'vectorized'